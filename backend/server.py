@@ -3,190 +3,2957 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+from gridfs.errors import NoFile
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterable, Iterator, Callable, Awaitable
 import uuid
 from datetime import datetime, timedelta
 import json
+import codecs
 import pandas as pd
+from pandas.io.parsers import TextParser
+import openpyxl
+import xlrd
 import io
 import bcrypt
 import jwt
 import base64
-from openai import OpenAI
-from sklearn.metrics.pairwise import cosine_similarity
+import asyncio
+import hashlib
+import heapq
+import math
+import random
+import re
+import tempfile
+import pickle
+import queue
+import unicodedata
+import multiprocessing
+import threading
+import time
+import fcntl
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
 import numpy as np
 
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to a characters-per-token estimate
+    tiktoken = None
+
+try:
+    import hnswlib
+except ImportError:  # HNSW indexes fall back to the pure-Python graph
+    hnswlib = None
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+upload_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="uploads")  # Raw uploads waiting for ingestion
+
+# OpenAI client, sharing one pooled keep-alive HTTP client across all requests
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', 100))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 60))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 5))
+OPENAI_EMBEDDING_TIMEOUT = float(os.environ.get('OPENAI_EMBEDDING_TIMEOUT', 30))
+OPENAI_CHAT_TIMEOUT = float(os.environ.get('OPENAI_CHAT_TIMEOUT', 60))
+OPENAI_WARM_CONNECTIONS = int(os.environ.get('OPENAI_WARM_CONNECTIONS', 2))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 6))
+OPENAI_RETRY_BASE_DELAY = float(os.environ.get('OPENAI_RETRY_BASE_DELAY', 0.5))
+OPENAI_RETRY_MAX_DELAY = float(os.environ.get('OPENAI_RETRY_MAX_DELAY', 30))
+
+openai_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+    ),
+    timeout=httpx.Timeout(OPENAI_CHAT_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+)
+# Retries are handled by OpenAIRateLimiter so backoff can account for every in-flight call
+openai_client = AsyncOpenAI(api_key=os.environ['OPENAI_API_KEY'], http_client=openai_http_client, max_retries=0)
+
+# Embedding request settings
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', 1536))
+EMBEDDING_BATCH_MAX_INPUTS = int(os.environ.get('EMBEDDING_BATCH_MAX_INPUTS', 2048))  # Provider limit on inputs per request
+EMBEDDING_BATCH_MAX_TOKENS = int(os.environ.get('EMBEDDING_BATCH_MAX_TOKENS', 250000))  # Kept under the provider's 300k tokens per request
+EMBEDDING_CONCURRENCY = int(os.environ.get('EMBEDDING_CONCURRENCY', 4))
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.environ.get('EMBEDDING_REQUESTS_PER_MINUTE', 3000))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.environ.get('EMBEDDING_TOKENS_PER_MINUTE', 1000000))
+EMBEDDING_BYTES_PER_TOKEN = 2  # Conservative estimate used when tiktoken is unavailable; digit-heavy rows tokenise densely
+
+# JWT settings
+JWT_SECRET = "your-secret-key-change-in-production"
+JWT_ALGORITHM = "HS256"
+JWT_EXPIRATION = timedelta(days=7)
+
+# Embedding cache settings
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+EMBEDDING_LRU_MAX_BYTES = int(os.environ.get('EMBEDDING_LRU_MAX_BYTES', 64 * 1024 * 1024))  # In-process tier of the content cache
+QUERY_EMBEDDING_LRU_MAX_BYTES = int(os.environ.get('QUERY_EMBEDDING_LRU_MAX_BYTES', 16 * 1024 * 1024))  # In-process tier of the query cache
+EMBEDDING_STORE_TTL_DAYS = int(os.environ.get('EMBEDDING_STORE_TTL_DAYS', 90))  # Content cache entries expire from Mongo after this long
+
+# Storage settings
+CHUNK_INSERT_BATCH_SIZE = int(os.environ.get('CHUNK_INSERT_BATCH_SIZE', 500))
+VECTOR_STORE = os.environ.get('VECTOR_STORE', 'mongo')  # "mongo" keeps vectors in the chunks collection, "mmap" in on-disk segments
+VECTOR_STORE_DIR = Path(os.environ.get('VECTOR_STORE_DIR', ROOT_DIR / 'vector_store'))
+STORE_COPY_ROWS = int(os.environ.get('STORE_COPY_ROWS', 8192))  # Rows the vector store copies per block when appending or compacting
+
+# Search settings
+SIMILARITY_THRESHOLD = 0.1  # Minimum cosine similarity for a chunk to count as relevant
+SEARCH_TOP_K = 5
+SEARCH_PER_DOCUMENT_CAP = int(os.environ['SEARCH_PER_DOCUMENT_CAP']) if os.environ.get('SEARCH_PER_DOCUMENT_CAP') else None
+if SEARCH_PER_DOCUMENT_CAP is not None and SEARCH_PER_DOCUMENT_CAP < 1:
+    raise ValueError(f"SEARCH_PER_DOCUMENT_CAP must be at least 1, got {SEARCH_PER_DOCUMENT_CAP}")
+ANN_MIN_ROWS = int(os.environ.get('ANN_MIN_ROWS', 200000))  # Corpus size above which "auto" switches to the HNSW index
+QUANTIZATION_TYPES = ("none", "int8", "binary", "prefix")
+EMBEDDING_PREFIX_DIMENSIONS = int(os.environ.get('EMBEDDING_PREFIX_DIMENSIONS', 256))
+IVF_RETRAIN_GROWTH = float(os.environ.get('IVF_RETRAIN_GROWTH', 2.0))  # Retrain IVF centroids once the corpus grows by this factor
+
+# Chat request settings
+CHAT_MODEL = "gpt-4o-mini"
+CHAT_MAX_TOKENS = 500
+CHAT_CONCURRENCY = int(os.environ.get('CHAT_CONCURRENCY', 16))
+CHAT_REQUESTS_PER_MINUTE = int(os.environ.get('CHAT_REQUESTS_PER_MINUTE', 5000))
+CHAT_TOKENS_PER_MINUTE = int(os.environ.get('CHAT_TOKENS_PER_MINUTE', 2000000))
+
+# Ingestion job settings
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 2))
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 1000))  # Chunks embedded and written between checkpoints
+INGEST_LEASE_SECONDS = int(os.environ.get('INGEST_LEASE_SECONDS', 300))  # A job whose lease lapses is resumed by another worker
+INGEST_POLL_INTERVAL = float(os.environ.get('INGEST_POLL_INTERVAL', 5))
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 3))
+INGEST_EMBED_WORKERS = int(os.environ.get('INGEST_EMBED_WORKERS', 4))  # Batches of one upload embedded concurrently
+INGEST_QUEUE_DEPTH = int(os.environ.get('INGEST_QUEUE_DEPTH', 4))  # Batches buffered between pipeline stages
+
+# CPU worker pool settings
+CPU_POOL_TYPE = os.environ.get('CPU_POOL_TYPE', 'process')  # "process", or "thread" where worker processes are unavailable
+CPU_POOL_WORKERS = int(os.environ.get('CPU_POOL_WORKERS', min(4, os.cpu_count() or 1)))
+CPU_POOL_MAX_QUEUE = int(os.environ.get('CPU_POOL_MAX_QUEUE', 16))  # Tasks waiting or running beyond this are rejected with 503
+CPU_TASK_TIMEOUT = float(os.environ.get('CPU_TASK_TIMEOUT', 120))  # Seconds before a caller gives up with 504
+
+# Batch query settings
+BATCH_QUERY_MAX_QUERIES = int(os.environ.get('BATCH_QUERY_MAX_QUERIES', 100))
+BATCH_QUERY_CONCURRENCY = int(os.environ.get('BATCH_QUERY_CONCURRENCY', 8))
+
+# Answer cache settings
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 256))  # Recent answers kept per tenant, 0 disables the cache
+
+# Create the main app without a prefix
+app = FastAPI(title="RAG SaaS Application", description="AI-powered document analysis and reporting")
+
+# Create a router with the /api prefix
+api_router = APIRouter(prefix="/api")
+
+# Security
+security = HTTPBearer()
+
+# Models
+class User(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    email: str
+    name: str
+    password_hash: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class UserCreate(BaseModel):
+    email: str
+    name: str
+    password: str
+
+class UserLogin(BaseModel):
+    email: str
+    password: str
+
+class Document(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    filename: str
+    file_type: str
+    chunks_count: int = 0
+    embedding_dim: int = 0
+    vector_store: str = "mongo"  # Where the chunk vectors live: "mongo" or "mmap"
+    revision: int = 0  # Bumped each time a new version of the file is merged in
+    uploaded_at: datetime = Field(default_factory=datetime.utcnow)
+    processed: bool = False
+
+class DocumentChunk(BaseModel):
+    user_id: str
+    document_id: str
+    ordinal: int
+    text: str
+    content: Any
+    embedding: Optional[bytes] = None  # Little-endian float32 vector, unset when stored on disk
+    row_hash: Optional[str] = None  # Hash of the chunk text, used to diff new versions of the file
+    pending_job: Optional[str] = None  # Set on rows added by an update job until it commits
+
+class IngestJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    document_id: str
+    filename: str
+    file_type: str
+    file_id: Any  # GridFS id of the raw upload
+    status: str = "queued"  # "queued", "running", "completed", "failed" or "cancelled"
+    total_chunks: int = 0  # Known once the whole file has been read
+    processed_chunks: int = 0  # Checkpoint: chunks embedded and written so far
+    embedding_dim: int = 0  # Dimension of the vectors written so far, 0 until the first batch
+    base_revision: Optional[int] = None  # Revision of the document a new version updates, None for a new document
+    attempts: int = 0
+    error: Optional[str] = None
+    worker_id: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class SearchSettings(BaseModel):
+    index_type: str = "auto"  # "auto", "flat", "hnsw" or "ivf"
+    ann_min_rows: int = ANN_MIN_ROWS
+    hnsw_m: int = Field(default=16, ge=2, le=128)
+    hnsw_ef_construction: int = Field(default=200, ge=8, le=2000)
+    hnsw_ef_search: int = Field(default=64, ge=1, le=2000)
+    ivf_nlist: int = Field(default=0, ge=0)  # 0 picks 4 * sqrt(rows) lists
+    ivf_nprobe: int = Field(default=8, ge=1)
+    quantization: str = "none"  # "none", "int8", "binary" or "prefix" first pass before full-precision rerank
+    rerank_candidates: int = Field(default=200, ge=1, le=10000)
+    answer_cache_similarity: float = Field(default=0.95, ge=0.5, le=1.0)  # Cosine similarity at which a recent answer is reused
+
+class QueryRequest(BaseModel):
+    query: str
+    language: str = "en"  # "en" or "id"
+
+class QueryResponse(BaseModel):
+    answer: str
+    sources: List[str]
+    context_used: List[str]
+
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest]
+
+class BatchQueryResponse(BaseModel):
+    results: List[QueryResponse]
+
+# OpenAI rate limiting
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse a rate-limit reset header such as "6m0s", "1.5s" or "20ms" into seconds"""
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Read the server's suggested retry delay in seconds, if it sent one"""
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+class RateLimitBudget:
+    """Token bucket refilled continuously at a per-minute rate, corrected by the provider's headers"""
+    
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+    
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until the bucket holds amount (capped at its capacity)"""
+        self.refill(now)
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing * 60 / self.capacity)
+    
+    def take(self, amount: float):
+        self.available -= amount
+    
+    def sync(self, limit: Optional[str], remaining: Optional[str], reset: Optional[str]):
+        """Adopt the provider's view of the limit and what is left of it"""
+        now = time.monotonic()
+        self.refill(now)
+        try:
+            if limit:
+                self.capacity = max(1.0, float(limit))
+            if remaining is not None:
+                self.available = min(self.available, float(remaining))
+        except ValueError:
+            return
+        reset_seconds = parse_reset_duration(reset)
+        if remaining is not None and self.available <= 0 and reset_seconds:
+            # Nothing left: hold off until the provider says the window has refilled
+            self.available = min(self.available, -reset_seconds * self.capacity / 60)
+
+class OpenAIRateLimiter:
+    """Shared gate for one model's API calls: RPM/TPM budgets, AIMD concurrency and jittered retries"""
+    
+    def __init__(self, max_concurrency: int, requests_per_minute: int, tokens_per_minute: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.requests = RateLimitBudget(requests_per_minute)
+        self.tokens = RateLimitBudget(tokens_per_minute)
+        self.backoff_until = 0.0
+        self.condition = asyncio.Condition()
+    
+    async def acquire(self, tokens: int):
+        async with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    self.backoff_until - now,
+                    self.requests.wait_time(1, now),
+                    self.tokens.wait_time(tokens, now)
+                )
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    self.in_flight += 1
+                    return
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+    
+    def record_success(self, headers):
+        """Additive increase, and sync the budgets with the rate-limit headers"""
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+        self.requests.sync(
+            headers.get("x-ratelimit-limit-requests"),
+            headers.get("x-ratelimit-remaining-requests"),
+            headers.get("x-ratelimit-reset-requests")
+        )
+        self.tokens.sync(
+            headers.get("x-ratelimit-limit-tokens"),
+            headers.get("x-ratelimit-remaining-tokens"),
+            headers.get("x-ratelimit-reset-tokens")
+        )
+    
+    def record_rate_limited(self, retry_after: Optional[float]):
+        """Multiplicative decrease, and pause every caller until the suggested retry time"""
+        self.concurrency = max(1.0, self.concurrency / 2)
+        if retry_after:
+            self.backoff_until = max(self.backoff_until, time.monotonic() + retry_after)
+    
+    async def call(self, request, tokens: int):
+        """Run request() (a with_raw_response API call) under the limiter, retrying transient failures"""
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            retry_after = None
+            await self.acquire(tokens)
+            try:
+                raw_response = await request()
+            except RateLimitError as e:
+                retry_after = parse_retry_after(e.response.headers)
+                self.record_rate_limited(retry_after)
+                error = e
+            except (APIConnectionError, InternalServerError) as e:
+                error = e
+            else:
+                self.record_success(raw_response.headers)
+                return raw_response.parse()
+            finally:
+                await self.release()
+            
+            if attempt == OPENAI_MAX_RETRIES:
+                raise error
+            delay = min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt)
+            delay = max(retry_after or 0.0, random.uniform(0, delay))
+            logging.warning(f"OpenAI request failed ({error}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+embedding_rate_limiter = OpenAIRateLimiter(EMBEDDING_CONCURRENCY, EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE)
+chat_rate_limiter = OpenAIRateLimiter(CHAT_CONCURRENCY, CHAT_REQUESTS_PER_MINUTE, CHAT_TOKENS_PER_MINUTE)
+
+# CPU worker pool
+class CPUWorkerPool:
+    """Runs CPU-heavy functions such as report building off the event loop in worker processes
+
+    Falls back to threads when processes cannot be started. Calls beyond max_queue pending tasks are
+    rejected with a 503 and calls exceeding timeout with a 504, so one tenant's large file cannot
+    stall everyone else's requests. A timed-out task still finishes in its worker; only the caller
+    stops waiting.
+    """
+
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._executor = None
+
+    def executor(self):
+        if self._executor is None and CPU_POOL_TYPE == "process":
+            try:
+                # spawn, not fork: forking a process with live event loop and driver threads is unsafe
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            except (OSError, ImportError, NotImplementedError) as e:
+                logging.warning(f"Process pool unavailable, using threads: {e}")
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu-worker")
+        return self._executor
+
+    def submit(self, function, args):
+        future = self.executor().submit(function, *args)
+        # Count the task until its worker is done with it, even if the caller stopped waiting
+        with self._pending_lock:
+            self.pending += 1
+        future.add_done_callback(self._release)
+        return asyncio.wrap_future(future)
+
+    def _release(self, future):
+        with self._pending_lock:
+            self.pending -= 1
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._use_threads(future.exception())
+
+    def _use_threads(self, error: Exception):
+        with self._pending_lock:
+            if isinstance(self._executor, ProcessPoolExecutor):
+                logging.warning(f"Process pool failed, using threads: {error}")
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu-worker")
+
+    async def run(self, function, *args):
+        """Run function(*args) in the pool; function and arguments must be picklable"""
+        if self.pending >= self.max_queue:
+            raise HTTPException(status_code=503, detail="Server is busy, please try again shortly")
+        try:
+            try:
+                return await asyncio.wait_for(self.submit(function, args), timeout=self.timeout)
+            except BrokenProcessPool as e:
+                self._use_threads(e)
+                return await asyncio.wait_for(self.submit(function, args), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Processing took too long")
+
+    def start(self, function, *args) -> asyncio.Future:
+        """Start a task nobody waits on, such as an index build; the queue limit applies but not the timeout"""
+        if self.pending >= self.max_queue:
+            raise HTTPException(status_code=503, detail="Server is busy, please try again shortly")
+        return self.submit(function, args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+cpu_pool = CPUWorkerPool(CPU_POOL_WORKERS, CPU_POOL_MAX_QUEUE, CPU_TASK_TIMEOUT)
+
+# Streaming parsers spend most of their time waiting for embedding to catch up, so each ingest
+# worker gets a thread of its own here rather than holding a CPU pool worker for a whole upload
+ingest_parsers = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest-parser")
+
+# An in-memory corpus extends its ANN index on a thread sharing its matrix; a process worker
+# would be sent a pickled copy of the whole matrix and send the whole graph back every time
+ann_builders = ThreadPoolExecutor(max_workers=CPU_POOL_WORKERS, thread_name_prefix="ann-builder")
+
+# Content-addressed embedding cache
+class ContentEmbeddingCache:
+    """Embeddings keyed by a hash of (user, model, dimensions, text): an in-process LRU in front of a Mongo collection
+
+    Identical chunks of one tenant, e.g. the unchanged rows of a re-uploaded spreadsheet, are embedded
+    only once. Entries and counters are per tenant, so a hit never reveals what another tenant uploaded.
+    Counters are per process.
+    """
+
+    def __init__(self, max_bytes: int, collection: str = "embedding_cache"):
+        self.max_bytes = max_bytes
+        self.collection = collection
+        self.nbytes = 0
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._counters: Dict[str, Dict[str, float]] = {}
+
+    @staticmethod
+    def key(user_id: str, text: str) -> str:
+        return hashlib.sha256(f"{user_id}|{EMBEDDING_MODEL}|{EMBEDDING_DIMENSIONS}|{text}".encode("utf-8")).hexdigest()
+
+    def counters(self, user_id: str) -> Dict[str, float]:
+        # embed_seconds is the time spent embedding the misses, to estimate what the hits saved
+        return self._counters.setdefault(
+            user_id, {"memory_hits": 0, "store_hits": 0, "misses": 0, "embed_seconds": 0.0}
+        )
+
+    def remember(self, key: str, vector: np.ndarray):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = vector
+        self.nbytes += vector.nbytes
+        while self.nbytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    async def lookup(self, user_id: str, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Return the cached vectors for whichever of a user's keys are known, checking memory before Mongo"""
+        counters = self.counters(user_id)
+        found = {}
+        for key in keys:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                found[key] = vector
+        counters["memory_hits"] += len(found)
+        
+        remaining = [key for key in dict.fromkeys(keys) if key not in found]
+        for start in range(0, len(remaining), CHUNK_INSERT_BATCH_SIZE):
+            async for entry in db[self.collection].find({"_id": {"$in": remaining[start:start + CHUNK_INSERT_BATCH_SIZE]}}):
+                vector = np.frombuffer(entry["embedding"], dtype='<f4')
+                found[entry["_id"]] = vector
+                self.remember(entry["_id"], vector)
+                counters["store_hits"] += 1
+        return found
+
+    async def store(self, user_id: str, vectors: Dict[str, np.ndarray], seconds: float = 0.0):
+        """Add a user's freshly embedded vectors, which took `seconds` to embed, to both tiers"""
+        counters = self.counters(user_id)
+        counters["misses"] += len(vectors)
+        counters["embed_seconds"] += seconds
+        for key, vector in vectors.items():
+            self.remember(key, vector)
+        try:
+            entries = [
+                {"_id": key, "user_id": user_id, "embedding": pack_embeddings(vector), "created_at": datetime.utcnow()}
+                for key, vector in vectors.items()
+            ]
+            for start in range(0, len(entries), CHUNK_INSERT_BATCH_SIZE):
+                await db[self.collection].insert_many(entries[start:start + CHUNK_INSERT_BATCH_SIZE], ordered=False)
+        except BulkWriteError:
+            pass  # Another worker cached some of the same texts first
+        except Exception as e:
+            logging.warning(f"Error storing embeddings in the content cache: {e}")
+
+    def stats(self, user_id: str) -> Dict[str, Any]:
+        counters = self.counters(user_id)
+        hits = counters["memory_hits"] + counters["store_hits"]
+        lookups = hits + counters["misses"]
+        seconds_per_miss = counters["embed_seconds"] / counters["misses"] if counters["misses"] else 0.0
+        return {
+            "memory_hits": counters["memory_hits"],
+            "store_hits": counters["store_hits"],
+            "misses": counters["misses"],
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "avg_embed_ms": seconds_per_miss * 1000,
+            "estimated_seconds_saved": hits * seconds_per_miss
+        }
+
+content_cache = ContentEmbeddingCache(EMBEDDING_LRU_MAX_BYTES)
+# Query vectors get their own LRU so a large upload cannot evict the questions users keep asking
+query_cache = ContentEmbeddingCache(QUERY_EMBEDDING_LRU_MAX_BYTES, "query_embedding_cache")
+
+# Helper functions
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def create_jwt_token(user_id: str) -> str:
+    payload = {
+        "user_id": user_id,
+        "exp": datetime.utcnow() + JWT_EXPIRATION
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        user_id = payload.get("user_id")
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        
+        user = await db.users.find_one({"id": user_id})
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        
+        return User(**user)
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+@lru_cache(maxsize=1)
+def embedding_tokenizer():
+    """Load the embedding model's tokenizer, or None when tiktoken cannot provide it"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    except Exception as e:
+        logging.warning(f"Falling back to estimated token counts: {e}")
+        return None
+
+def count_embedding_tokens(texts: List[str]) -> List[int]:
+    """Count the tokens each text costs the embedding model"""
+    encoder = embedding_tokenizer()
+    if encoder is None:
+        return [max(1, math.ceil(len(text.encode("utf-8")) / EMBEDDING_BYTES_PER_TOKEN)) for text in texts]
+    return [max(1, len(tokens)) for tokens in encoder.encode_ordinary_batch(texts)]
+
+def plan_embedding_batches(
+    token_counts: List[int],
+    max_inputs: int = EMBEDDING_BATCH_MAX_INPUTS,
+    max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS
+) -> List[tuple[int, int]]:
+    """Split consecutive texts into (start, end) ranges that fit the per-request input and token limits"""
+    batches = []
+    start = 0
+    tokens = 0
+    for position, count in enumerate(token_counts):
+        if position > start and (position - start >= max_inputs or tokens + count > max_tokens):
+            batches.append((start, position))
+            start = position
+            tokens = 0
+        tokens += count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+async def request_embeddings(texts: List[str], tokens: int) -> np.ndarray:
+    """Embed one batch of texts in a single API request"""
+    response = await embedding_rate_limiter.call(
+        lambda: openai_client.embeddings.with_raw_response.create(
+            model=EMBEDDING_MODEL,
+            input=texts,
+            dimensions=EMBEDDING_DIMENSIONS,
+            encoding_format="base64",
+            timeout=OPENAI_EMBEDDING_TIMEOUT
+        ),
+        tokens
+    )
+    # base64 payloads decode straight into float32 without building a Python float per value
+    return np.stack([
+        np.frombuffer(base64.b64decode(embedding.embedding), dtype='<f4')
+        for embedding in sorted(response.data, key=lambda item: item.index)
+    ])
+
+async def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embed texts through the API in token-aware batches, in order"""
+    token_counts = count_embedding_tokens(texts)
+    batches = plan_embedding_batches(token_counts)
+    results = await asyncio.gather(*[
+        request_embeddings(texts[start:end], sum(token_counts[start:end]))
+        for start, end in batches
+    ])
+    return np.concatenate(results) if results else np.empty((0, 0), dtype=np.float32)
+
+async def get_embeddings(
+    user_id: str,
+    texts: List[str],
+    cache: ContentEmbeddingCache = content_cache,
+    cache_texts: Optional[List[str]] = None
+) -> np.ndarray:
+    """Generate embeddings as a float32 matrix (empty on failure); only texts missing from the user's cache reach OpenAI
+
+    Each text is cached under the matching entry of cache_texts, or under itself when that is not given.
+    """
+    try:
+        keys = [cache.key(user_id, text) for text in (texts if cache_texts is None else cache_texts)]
+        vectors = await cache.lookup(user_id, keys)
+        # The first text seen for each missing key is the one embedded
+        missing = {key: text for text, key in reversed(list(zip(texts, keys))) if key not in vectors}
+        if missing:
+            started = time.perf_counter()
+            embedded = dict(zip(missing, await embed_texts(list(missing.values()))))
+            await cache.store(user_id, embedded, time.perf_counter() - started)
+            vectors.update(embedded)
+        return np.stack([vectors[key] for key in keys]) if keys else np.empty((0, 0), dtype=np.float32)
+    except Exception as e:
+        logging.error(f"Error generating embeddings: {e}")
+        return np.empty((0, 0), dtype=np.float32)
+
+def normalize_query(query: str) -> str:
+    """Fold case, Unicode forms and whitespace so trivially different spellings of a question share a cache entry"""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+async def get_query_embeddings(user_id: str, queries: List[str]) -> np.ndarray:
+    """Embed search queries as typed, through the query cache keyed by the normalised query"""
+    return await get_embeddings(
+        user_id, queries, cache=query_cache, cache_texts=[normalize_query(query) for query in queries]
+    )
+
+# Cell text that pandas.read_excel treats as missing
+EXCEL_NA_VALUES = frozenset([
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"
+])
+
+# Strings pandas turns into booleans, and the shape of strings it may turn into numbers
+EXCEL_BOOL_STRINGS = frozenset(["True", "TRUE", "true", "False", "FALSE", "false"])
+EXCEL_NUMBER_PATTERN = re.compile(r"(\s*)([+-]?)(\d*)(\.\d*)?([eE][+-]?\d+)?(\s*)")
+
+def excel_cell_value(value: Any) -> Any:
+    """Normalise a cell value: blanks and NA markers become None, integral floats become ints"""
+    if isinstance(value, str) and value in EXCEL_NA_VALUES:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def excel_column_names(header: List[Any]) -> List[str]:
+    """Name columns like pandas.read_excel: blanks become "Unnamed: i" and repeats get ".1", ".2" suffixes"""
+    names = []
+    counts: Dict[str, int] = {}
+    for position, value in enumerate(header):
+        name = base = f"Unnamed: {position}" if value is None else str(value)
+        while name in counts:
+            counts[base] += 1
+            name = f"{base}.{counts[base]}"
+        counts.setdefault(name, 0)
+        names.append(name)
+    return names
+
+def read_xlsx_rows(file) -> Iterator[List[Any]]:
+    """Yield the first sheet's rows from an .xlsx file without loading the workbook into memory"""
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows():
+            yield [None if cell.data_type == "e" else excel_cell_value(cell.value) for cell in row]
+    finally:
+        workbook.close()
+
+def read_xls_rows(file) -> Iterator[List[Any]]:
+    """Yield the first sheet's rows from a legacy .xls file"""
+    workbook = xlrd.open_workbook(file_contents=file.read(), on_demand=True)
+    try:
+        sheet = workbook.sheet_by_index(0)
+        for index in range(sheet.nrows):
+            row = []
+            for cell in sheet.row(index):
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    row.append(xlrd.xldate.xldate_as_datetime(cell.value, workbook.datemode))
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    row.append(bool(cell.value))
+                elif cell.ctype == xlrd.XL_CELL_ERROR:
+                    row.append(None)
+                else:
+                    row.append(excel_cell_value(cell.value))
+            yield row
+    finally:
+        workbook.release_resources()
+
+def excel_value_kind(value: Any) -> Any:
+    """Bucket a cell value by everything pandas' column type inference depends on
+
+    Two values of the same kind never lead pandas to a different dtype for their column.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        if value in EXCEL_BOOL_STRINGS:
+            return ("bool", value)
+        match = EXCEL_NUMBER_PATTERN.fullmatch(value)
+        if match is None or not (match[3] or (match[4] or "")[1:]):
+            return ("text", value.strip().lower().lstrip("+-") in ("inf", "infinity"))
+        return ("number", bool(match[1]), bool(match[6]), match[2], len(match[3]) > 18, match[4] is not None, match[5] is not None)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return (int, value < 0, abs(value) >= 2 ** 63 - 1)
+    return type(value)
+
+def scan_excel_rows(rows: Iterator[List[Any]]) -> tuple[Optional[List[Any]], List[List[Any]]]:
+    """First pass over a sheet: its header row and, per column, one example of each kind of value it holds
+
+    Mirrors how pandas.read_excel lays out the sheet: trailing blanks are trimmed, short rows are padded
+    with missing values and blank rows between data rows count as missing values in every column.
+    """
+    header = None
+    kinds: List[Dict[Any, Any]] = []
+    data_rows = 0
+    blank_rows = 0
+    for values in rows:
+        width = len(values)
+        while width and values[width - 1] is None:
+            width -= 1
+        if header is None:
+            header = values[:width]
+            continue
+        if width == 0:
+            blank_rows += 1
+            continue
+        if blank_rows:
+            # Blank rows above this one are all-missing rows to pandas
+            for column in kinds:
+                column.setdefault(None, None)
+        while len(kinds) < width:
+            # Earlier rows had nothing in this column
+            kinds.append({None: None} if data_rows or blank_rows else {})
+        blank_rows = 0
+        data_rows += 1
+        for position, column in enumerate(kinds):
+            value = values[position] if position < width else None
+            kind = excel_value_kind(value)
+            if kind not in column:
+                column[kind] = value
+    if header is None or not data_rows:
+        return header, []
+    while len(kinds) < len(header):
+        kinds.append({None: None})
+    return header, [list(column.values()) for column in kinds]
+
+def build_row_chunks(columns: List[str], rows: List[List[Any]]) -> List[str]:
+    """Render each row as "column: value" pairs joined by " | ", skipping missing values
+
+    Works a column at a time over the whole batch: one missing-value mask for the batch, one pass of
+    str() per column, then every row is joined in a single sweep.
+    """
+    if not rows:
+        return []
+    matrix = np.empty((len(rows), len(columns)), dtype=object)
+    matrix[:] = rows
+    present = ~pd.isna(matrix)
+    
+    # Each present cell becomes " | column: value" and missing cells "", so a row is the concatenation
+    # of its pieces with the leading separator dropped
+    pieces = []
+    for position, column in enumerate(columns):
+        piece = np.full(len(rows), "", dtype=object)
+        column_present = present[:, position]
+        if column_present.any():
+            values = np.array(list(map(str, matrix[column_present, position])), dtype=object)
+            piece[column_present] = f" | {column}: " + values
+        pieces.append(piece)
+    return [chunk[3:] for chunk in map("".join, zip(*pieces))]
+
+def excel_batch(columns: List[str], examples: List[List[Any]], rows: List[List[Any]]) -> tuple[List[str], List[Dict[str, Any]]]:
+    """Convert raw row values the way pandas.read_excel converts the whole sheet, then render (chunks, row dicts)
+
+    The batch is parsed after a few probe rows holding every kind of value each column has anywhere in
+    the sheet, so pandas infers the sheet-wide column types, e.g. float for integers with blanks.
+    """
+    probe = [
+        [column[index % len(column)] for column in examples]
+        for index in range(max(len(column) for column in examples))
+    ]
+    # pandas reads blank cells as "", which its parser treats as missing
+    cells = [["" if value is None else value for value in values] for values in probe + rows]
+    frame = TextParser(cells, names=columns, header=None, skip_blank_lines=False).read().iloc[len(probe):]
+    return build_row_chunks(columns, frame.to_numpy(dtype=object).tolist()), frame.to_dict('records')
+
+def open_excel_rows(file) -> Iterator[List[Any]]:
+    signature = file.read(8)
+    file.seek(0)
+    return read_xls_rows(file) if signature.startswith(b"\xd0\xcf\x11\xe0") else read_xlsx_rows(file)
+
+def iter_excel_batches(file, batch_size: int) -> Iterator[tuple[List[str], List[Dict[str, Any]]]]:
+    """Stream the first sheet of an Excel upload as (chunks, rows) batches of at most batch_size rows
+
+    Chunks match what pandas.read_excel followed by the row-rendering loop used to produce, so corpora
+    ingested before streaming stay consistent. A cheap first pass records each column's kinds of value,
+    the second converts and renders batch by batch. The first row names the columns; fully blank rows
+    are skipped since they have nothing to embed.
+    """
+    rows = open_excel_rows(file)
+    try:
+        header, examples = scan_excel_rows(rows)
+    finally:
+        rows.close()
+    if not examples:
+        return
+    width = len(examples)
+    columns = excel_column_names(header + [None] * (width - len(header)))
+    
+    file.seek(0)
+    rows = open_excel_rows(file)
+    try:
+        next(rows, None)
+        batch = []
+        for values in rows:
+            if all(value is None for value in values):
+                continue
+            batch.append(values[:width] + [None] * (width - len(values)))
+            if len(batch) == batch_size:
+                yield excel_batch(columns, examples, batch)
+                batch = []
+        if batch:
+            yield excel_batch(columns, examples, batch)
+    finally:
+        rows.close()
+
+JSON_READ_SIZE = 1024 * 1024
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_DELIMITERS = frozenset([",", "]", "}", " ", "\t", "\n", "\r"])
+
+def iter_json_values(file) -> Iterator[Any]:
+    """Yield a JSON upload's items one at a time without decoding the whole file
+
+    Items are the elements of a top-level array, or every top-level value otherwise, which covers
+    both a single object and newline-delimited JSON (JSONL) of objects. Only the item being decoded and one
+    read block are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, position, eof = "", 0, False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        data = file.read(JSON_READ_SIZE)
+        eof = not data
+        buffer, position = buffer[position:] + text_decoder.decode(data, final=eof), 0
+
+    def peek() -> str:
+        """Skip whitespace and return the next character ("" at end of file) without consuming it"""
+        nonlocal position
+        while True:
+            position = JSON_WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or eof:
+                return buffer[position:position + 1]
+            read_more()
+
+    def next_value() -> Any:
+        nonlocal position
+        while True:
+            peek()
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                # A number cut by the end of the block (e.g. "0." of "0.25") decodes too early, so only
+                # accept a value once the character after it is visibly a delimiter
+                if eof or buffer[end:end + 1] in JSON_DELIMITERS:
+                    position = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+
+    if peek() == "[":
+        position += 1
+        if peek() == "]":
+            position += 1
+        else:
+            while True:
+                yield next_value()
+                separator = peek()
+                position += 1
+                if separator == "]":
+                    break
+                if separator != ",":
+                    raise ValueError("Expected ',' or ']' between JSON array items")
+        if peek():
+            raise ValueError("Unexpected data after the JSON array")
+    else:
+        while peek():
+            yield next_value()
+
+def json_item_chunk(item: Any) -> str:
+    """Render a JSON item as "key: value" pairs, or its string form when it is not an object"""
+    if isinstance(item, dict):
+        return " | ".join([f"{k}: {v}" for k, v in item.items()])
+    return str(item)
+
+def iter_json_batches(file, batch_size: int) -> Iterator[tuple[List[str], List[Any]]]:
+    """Stream a JSON or JSONL upload as (chunks, items) batches of at most batch_size items"""
+    batch = []
+    for item in iter_json_values(file):
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield [json_item_chunk(item) for item in batch], batch
+            batch = []
+    if batch:
+        yield [json_item_chunk(item) for item in batch], batch
+
+def pack_embeddings(embeddings) -> bytes:
+    """Pack an embedding matrix into contiguous little-endian float32 bytes for storage"""
+    return np.ascontiguousarray(embeddings, dtype='<f4').tobytes()
+
+def unpack_embeddings(doc: Dict[str, Any]) -> np.ndarray:
+    """Return a stored document's embeddings as a float32 matrix without copying the packed bytes"""
+    embeddings = doc["embeddings"]
+    if isinstance(embeddings, (bytes, bytearray)):
+        return np.frombuffer(embeddings, dtype='<f4').reshape(-1, doc["embedding_dim"])
+    # Legacy documents store a list of float lists
+    return np.asarray(embeddings, dtype=np.float32)
+
+def row_hash(chunk: str) -> str:
+    """Identify a row by its chunk text, so unchanged rows can be matched across versions of a file"""
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+async def write_document_chunks(
+    document: Document,
+    chunks: List[str],
+    data: List[Any],
+    embeddings: np.ndarray,
+    start_ordinal: int = 0,
+    pending_job: Optional[str] = None
+):
+    """Insert a document's chunks into the chunks collection in batches, with packed embeddings unless they live on disk"""
+    with_embeddings = document.vector_store == "mongo"
+    for start in range(0, len(chunks), CHUNK_INSERT_BATCH_SIZE):
+        end = start + CHUNK_INSERT_BATCH_SIZE
+        batch = [
+            DocumentChunk(
+                user_id=document.user_id,
+                document_id=document.id,
+                ordinal=start_ordinal + start + offset,
+                text=chunk,
+                content=row,
+                embedding=pack_embeddings(embedding) if with_embeddings else None,
+                row_hash=row_hash(chunk),
+                pending_job=pending_job
+            ).dict(exclude_none=True)
+            for offset, (chunk, row, embedding) in enumerate(zip(chunks[start:end], data[start:end], embeddings[start:end]))
+        ]
+        await db.chunks.insert_many(batch, ordered=False)
+
+async def load_document_chunks(
+    user_id: str,
+    document_ids: List[str],
+    pending_job: Optional[str] = None
+) -> Dict[str, tuple[List[str], Optional[np.ndarray]]]:
+    """Load (chunk texts, float32 embedding matrix) per document from the chunks collection
+
+    The matrix is None for documents whose vectors live in the on-disk vector store. Rows an
+    update job has not committed yet are only returned when that job's id is given.
+    """
+    rows = await db.chunks.find(
+        {"user_id": user_id, "document_id": {"$in": document_ids}, "pending_job": pending_job},
+        {"_id": 0, "document_id": 1, "text": 1, "embedding": 1}
+    ).sort([("user_id", 1), ("document_id", 1), ("ordinal", 1)]).to_list(None)
+
+    grouped: Dict[str, tuple[List[str], List[bytes]]] = {}
+    for row in rows:
+        texts, vectors = grouped.setdefault(row["document_id"], ([], []))
+        texts.append(row["text"])
+        if "embedding" in row:
+            vectors.append(row["embedding"])
+    return {
+        document_id: (texts, np.frombuffer(b"".join(vectors), dtype='<f4').reshape(len(texts), -1) if vectors else None)
+        for document_id, (texts, vectors) in grouped.items()
+    }
+
+def normalize_embeddings(embeddings) -> np.ndarray:
+    """Convert embeddings to a contiguous L2-normalised float32 matrix"""
+    matrix = np.array(embeddings, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+# Vector indexes
+class ANNIndex:
+    """Base for the approximate indexes, which are built in CPU pool workers and persisted with pickle
+
+    Every index covers corpus rows [0, count). remap() renumbers them after compaction instead of
+    rebuilding: new_ids[old_row] is the row's new number, or -1 for a dropped row.
+    """
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+class HNSWIndex(ANNIndex):
+    """Hierarchical navigable small world graph over corpus rows, scored by dot product on normalised vectors
+
+    The index only stores the graph; vectors are read from the matrix passed to insert() and search(),
+    so node ids are corpus row numbers. Deleted rows stay in the graph as tombstones and are filtered
+    out by the caller's live mask.
+    """
+
+    index_type = "hnsw"
+
+    def __init__(self, m: int = 16, ef_construction: int = 200, seed: int = 42):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.level_mult = 1 / math.log(max(m, 2))
+        self.rng = random.Random(seed)
+        self.layers: List[Dict[int, List[int]]] = []
+        self.entry_point: Optional[int] = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def matches(self, settings: "SearchSettings", size: int) -> bool:
+        return (self.m, self.ef_construction) == (settings.hnsw_m, settings.hnsw_ef_construction)
+
+    def _max_neighbours(self, layer: int) -> int:
+        # Layer 0 is denser than the upper layers
+        return 2 * self.m if layer == 0 else self.m
+
+    def _search_layer(self, matrix: np.ndarray, query: np.ndarray, entry_points: List[int], ef: int, layer: int) -> List[tuple[float, int]]:
+        """Best-first beam search of one layer, returning up to ef (score, node) pairs best first"""
+        graph = self.layers[layer]
+        visited = set(entry_points)
+        scores = (matrix[entry_points] @ query).tolist()
+        candidates = [(-score, node) for score, node in zip(scores, entry_points)]
+        results = [(score, node) for score, node in zip(scores, entry_points)]
+        heapq.heapify(candidates)
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            negative_score, node = heapq.heappop(candidates)
+            if -negative_score < results[0][0] and len(results) >= ef:
+                break
+            neighbours = [n for n in graph.get(node, ()) if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for score, neighbour in zip((matrix[neighbours] @ query).tolist(), neighbours):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbour))
+                    heapq.heappush(results, (score, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _select_neighbours(self, matrix: np.ndarray, candidates: List[tuple[float, int]], count: int) -> List[int]:
+        """Neighbour selection heuristic: prefer candidates closer to the new node than to any already selected"""
+        selected: List[int] = []
+        for score, node in candidates:
+            if len(selected) >= count:
+                break
+            if not selected or float(np.max(matrix[selected] @ matrix[node])) < score:
+                selected.append(node)
+        if len(selected) < count:
+            chosen = set(selected)
+            selected.extend([node for _, node in candidates if node not in chosen][:count - len(selected)])
+        return selected
+
+    def insert(self, matrix: np.ndarray, nodes):
+        """Insert corpus rows into the graph; matrix must contain every row already in the index"""
+        for node in nodes:
+            node = int(node)
+            level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+            while len(self.layers) <= level:
+                self.layers.append({})
+            for layer in range(level + 1):
+                self.layers[layer][node] = []
+
+            if self.entry_point is None:
+                self.entry_point = node
+                self.count += 1
+                continue
+
+            query = matrix[node]
+            entry_points = [self.entry_point]
+            top_layer = self._level_of(self.entry_point)
+            for layer in range(top_layer, level, -1):
+                entry_points = [self._search_layer(matrix, query, entry_points, 1, layer)[0][1]]
+
+            for layer in range(min(level, top_layer), -1, -1):
+                candidates = self._search_layer(matrix, query, entry_points, self.ef_construction, layer)
+                neighbours = self._select_neighbours(matrix, candidates, self.m)
+                graph = self.layers[layer]
+                graph[node] = neighbours
+                limit = self._max_neighbours(layer)
+                for neighbour in neighbours:
+                    links = graph[neighbour]
+                    links.append(node)
+                    if len(links) > limit:
+                        scores = matrix[links] @ matrix[neighbour]
+                        graph[neighbour] = [links[i] for i in np.argsort(-scores)[:limit]]
+                entry_points = [n for _, n in candidates]
+
+            if level > top_layer:
+                self.entry_point = node
+            self.count += 1
+
+    def _level_of(self, node: int) -> int:
+        level = 0
+        while level + 1 < len(self.layers) and node in self.layers[level + 1]:
+            level += 1
+        return level
+
+    def remap(self, new_ids: np.ndarray):
+        """Renumber the nodes, dropping removed ones; a link to a dropped node is replaced by that node's own links"""
+        ids = new_ids.tolist()
+        layers = []
+        for layer, graph in enumerate(self.layers):
+            limit = self._max_neighbours(layer)
+            remapped = {}
+            for node, links in graph.items():
+                if ids[node] < 0:
+                    continue
+                seen, kept = {ids[node]}, []
+                for link in links:
+                    for candidate in ([link] if ids[link] >= 0 else graph.get(link, ())):
+                        if ids[candidate] >= 0 and ids[candidate] not in seen:
+                            seen.add(ids[candidate])
+                            kept.append(ids[candidate])
+                remapped[ids[node]] = kept[:limit]
+            layers.append(remapped)
+        while layers and not layers[-1]:
+            layers.pop()
+
+        self.layers = layers
+        if self.entry_point is not None and ids[self.entry_point] >= 0:
+            self.entry_point = ids[self.entry_point]
+        else:
+            self.entry_point = next(iter(layers[-1])) if layers else None
+        self.count = int(np.count_nonzero(new_ids[:self.count] >= 0))
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, k: int, ef: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return up to max(k, ef) candidate (rows, scores), best first"""
+        if self.entry_point is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        entry_points = [self.entry_point]
+        for layer in range(len(self.layers) - 1, 0, -1):
+            entry_points = [self._search_layer(matrix, query, entry_points, 1, layer)[0][1]]
+        results = self._search_layer(matrix, query, entry_points, max(k, ef), 0)
+        rows = np.array([node for _, node in results], dtype=np.int64)
+        scores = np.array([score for score, _ in results], dtype=np.float32)
+        return rows, scores
+
+class HNSWLibIndex(ANNIndex):
+    """HNSW graph held by hnswlib, used in place of HNSWIndex when hnswlib is installed
+
+    hnswlib labels are handed out once per inserted row and never reused; rows maps each label to
+    its current corpus row, so remapping only rewrites that map and marks dropped labels deleted.
+    """
+
+    index_type = "hnsw"
+
+    def __init__(self, m: int = 16, ef_construction: int = 200, seed: int = 42):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.seed = seed
+        self.graph = None
+        self.rows = np.empty(0, dtype=np.int64)
+        self.deleted = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def matches(self, settings: "SearchSettings", size: int) -> bool:
+        return (self.m, self.ef_construction) == (settings.hnsw_m, settings.hnsw_ef_construction)
+
+    def insert(self, matrix: np.ndarray, nodes):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if len(nodes) == 0:
+            return
+        vectors = np.asarray(matrix[nodes], dtype=np.float32)
+        if self.graph is None:
+            self.graph = hnswlib.Index(space="ip", dim=vectors.shape[1])
+            self.graph.init_index(max_elements=len(nodes), ef_construction=self.ef_construction, M=self.m, random_seed=self.seed)
+        labels = len(self.rows) + len(nodes)
+        if labels > self.graph.get_max_elements():
+            self.graph.resize_index(max(labels, 2 * self.graph.get_max_elements()))
+        self.graph.add_items(vectors, np.arange(len(self.rows), labels))
+        self.rows = np.concatenate([self.rows, nodes])
+        self.count += len(nodes)
+
+    def remap(self, new_ids: np.ndarray):
+        alive = self.rows >= 0
+        rows = np.full(len(self.rows), -1, dtype=np.int64)
+        rows[alive] = new_ids[self.rows[alive]]
+        for label in np.flatnonzero(alive & (rows < 0)):
+            self.graph.mark_deleted(int(label))
+        self.deleted += int(np.count_nonzero(alive & (rows < 0)))
+        self.rows = rows
+        self.count = int(np.count_nonzero(new_ids[:self.count] >= 0))
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, k: int, ef: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return up to max(k, ef) candidate (rows, scores), best first"""
+        live = len(self.rows) - self.deleted
+        if self.graph is None or live == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        k = min(max(k, ef), live)
+        self.graph.set_ef(max(ef, k))
+        labels, distances = self.graph.knn_query(np.asarray(query, dtype=np.float32).reshape(1, -1), k=k)
+        # Inner-product distance is 1 - dot product
+        return self.rows[labels[0].astype(np.int64)], (1.0 - distances[0]).astype(np.float32)
+
+class IVFIndex(ANNIndex):
+    """Inverted-file index: spherical k-means centroids, each with a posting list of corpus rows
+
+    Queries score only the rows in the nprobe lists whose centroids are closest to the query.
+    """
+
+    index_type = "ivf"
+
+    def __init__(self, nlist: int = 0, iterations: int = 10, seed: int = 42):
+        self.nlist_setting = nlist
+        self.iterations = iterations
+        self.rng = np.random.default_rng(seed)
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[np.ndarray] = []
+        self.trained_rows = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def matches(self, settings: "SearchSettings", size: int) -> bool:
+        # Retrain once the corpus has grown enough that the centroids no longer describe it well
+        return (
+            self.nlist_setting == settings.ivf_nlist
+            and size <= max(self.trained_rows, 1) * IVF_RETRAIN_GROWTH
+        )
+
+    def _assign(self, vectors: np.ndarray, block: int = 65536) -> np.ndarray:
+        return np.concatenate([
+            np.argmax(vectors[start:start + block] @ self.centroids.T, axis=1)
+            for start in range(0, len(vectors), block)
+        ]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+    def train(self, matrix: np.ndarray):
+        """Run spherical k-means on a sample of the matrix to place the centroids"""
+        nlist = self.nlist_setting or int(4 * math.sqrt(len(matrix)))
+        nlist = max(1, min(nlist, len(matrix)))
+        sample_size = min(len(matrix), nlist * 64)
+        sample = matrix[np.sort(self.rng.choice(len(matrix), size=sample_size, replace=False))]
+
+        centroids = sample[self.rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            self.centroids = centroids
+            assignments = self._assign(sample)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = ~np.bincount(assignments, minlength=nlist).astype(bool)
+            # Re-seed empty clusters from random sample rows
+            sums[empty] = sample[self.rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize_embeddings(sums)
+        self.centroids = centroids
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+        self.trained_rows = len(matrix)
+
+    def remap(self, new_ids: np.ndarray):
+        self.lists = [new_ids[members][new_ids[members] >= 0] for members in self.lists]
+        self.count = int(np.count_nonzero(new_ids[:self.count] >= 0))
+
+    def insert(self, matrix: np.ndarray, nodes):
+        """Append corpus rows to the posting list of their nearest centroid, training first if needed"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if self.centroids is None:
+            if len(nodes) == 0:
+                return
+            self.train(matrix)
+        assignments = self._assign(matrix[nodes])
+        order = np.argsort(assignments, kind="stable")
+        lists, starts = np.unique(assignments[order], return_index=True)
+        for list_id, members in zip(lists, np.split(nodes[order], starts[1:])):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], members])
+        self.count += len(nodes)
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, nprobe: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return every (row, score) in the nprobe posting lists closest to the query"""
+        if self.centroids is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        centroid_scores = self.centroids @ query
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        rows = np.concatenate([self.lists[list_id] for list_id in probe])
+        return rows, matrix[rows] @ query
+
+class Int8Codes:
+    """Int8 scalar-quantised copy of the corpus matrix (one scale per vector) for a cheap first search pass"""
+
+    kind = "int8"
+
+    def __init__(self, block_rows: int = 16384):
+        self.block_rows = block_rows
+        self.codes = np.empty((0, 0), dtype=np.int8)
+        self.scales = np.empty(0, dtype=np.float32)
+        self.count = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+    def extend(self, matrix: np.ndarray):
+        """Quantise the matrix rows that are not covered yet"""
+        vectors = np.asarray(matrix[self.count:], dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        self.codes = np.concatenate([self.codes.reshape(-1, vectors.shape[1]), codes])
+        self.scales = np.concatenate([self.scales, scales.astype(np.float32)])
+        self.count = len(self.codes)
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        """Approximate dot products, de-quantising one block at a time to keep the working set small"""
+        scores = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, self.block_rows):
+            end = start + self.block_rows
+            scores[start:end] = (self.codes[start:end].astype(np.float32) @ query) * self.scales[start:end]
+        return scores
+
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+def popcount_rows(bits: np.ndarray) -> np.ndarray:
+    """Number of set bits in each row of a packed uint8 matrix"""
+    if hasattr(np, "bitwise_count"):
+        if bits.shape[1] % 8 == 0:
+            # Count 64 bits at a time where the row width allows it
+            bits = np.ascontiguousarray(bits).view(np.uint64)
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.int32)
+    return POPCOUNT_TABLE[bits].sum(axis=1, dtype=np.int32)
+
+class BinaryCodes:
+    """One sign bit per dimension, packed into bytes, scanned with Hamming distance as a first search pass"""
+
+    kind = "binary"
+
+    def __init__(self, block_rows: int = 65536):
+        self.block_rows = block_rows
+        self.bits = np.empty((0, 0), dtype=np.uint8)
+        self.dim = 0
+        self.count = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def extend(self, matrix: np.ndarray):
+        """Pack the sign bits of the matrix rows that are not covered yet"""
+        vectors = np.asarray(matrix[self.count:])
+        self.dim = vectors.shape[1]
+        bits = np.packbits(vectors > 0, axis=1)
+        self.bits = np.concatenate([self.bits.reshape(-1, bits.shape[1]), bits])
+        self.count = len(self.bits)
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        """Agreeing minus disagreeing sign bits, which ranks rows by increasing Hamming distance"""
+        query_bits = np.packbits(query > 0)
+        scores = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, self.block_rows):
+            end = start + self.block_rows
+            distances = popcount_rows(np.bitwise_xor(self.bits[start:end], query_bits))
+            scores[start:end] = self.dim - 2 * distances
+        return scores
+
+def matryoshka_prefix(vectors, dimensions: int = EMBEDDING_PREFIX_DIMENSIONS) -> np.ndarray:
+    """Truncate embeddings to their leading dimensions and renormalise (valid for text-embedding-3 models)"""
+    return normalize_embeddings(np.asarray(vectors, dtype=np.float32)[..., :dimensions])
+
+class PrefixCodes:
+    """Reduced-dimension (Matryoshka prefix) copy of the corpus matrix for a cheap first search pass"""
+
+    kind = "prefix"
+
+    def __init__(self, vectors: Optional[np.ndarray] = None):
+        self.vectors = vectors if vectors is not None else np.empty((0, 0), dtype=np.float32)
+        self.count = len(self.vectors)
+
+    @property
+    def nbytes(self) -> int:
+        # A prefix file mapped from the vector store lives in the shared page cache
+        return 0 if isinstance(self.vectors, np.memmap) else self.vectors.nbytes
+
+    def extend(self, matrix: np.ndarray):
+        """Compute prefixes for the matrix rows that are not covered yet"""
+        prefixes = matryoshka_prefix(matrix[self.count:])
+        self.vectors = np.concatenate([self.vectors.reshape(-1, prefixes.shape[1]), prefixes])
+        self.count = len(self.vectors)
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        return self.vectors @ matryoshka_prefix(query, self.vectors.shape[1])[0]
+
+COARSE_INDEX_TYPES = {"int8": Int8Codes, "binary": BinaryCodes, "prefix": PrefixCodes}
+
+# On-disk vector store
+class MmapVectorStore:
+    """Append-only float32 vector file per user, memory-mapped so workers share page-cache pages
+
+    manifest.json records the vector dimension, the rows in the current data file and, per stored
+    document, its row ranges in document order plus the rows an update has tombstoned. Updates
+    leave kept rows where they are and append only added ones. Dead rows stay in the file until
+    compaction rewrites it under the next generation number. A parallel prefix file keeps the renormalised Matryoshka prefix
+    of every row for coarse search. Writers serialise on a file lock; readers never lock.
+    """
+
+    def __init__(self, user_id: str, root: Path = VECTOR_STORE_DIR):
+        self.directory = Path(root) / user_id
+        self.manifest_path = self.directory / "manifest.json"
+
+    @contextmanager
+    def _locked(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _data_path(self, generation: int) -> Path:
+        return self.directory / f"vectors-{generation}.f32"
+
+    def _prefix_path(self, generation: int) -> Path:
+        return self.directory / f"prefix-{generation}.f32"
+
+    def read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"generation": 0, "dim": 0, "prefix_dim": 0, "rows": 0, "documents": {}}
+
+    def _write_manifest(self, manifest: Dict[str, Any]):
+        temporary_path = self.manifest_path.with_suffix(".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.manifest_path)
+
+    def open(self, manifest: Optional[Dict[str, Any]] = None) -> np.ndarray:
+        """Memory-map the rows recorded in the manifest as a read-only (rows, dim) float32 matrix"""
+        manifest = manifest or self.read_manifest()
+        if manifest["rows"] == 0:
+            return np.empty((0, manifest["dim"]), dtype=np.float32)
+        return np.memmap(
+            self._data_path(manifest["generation"]),
+            dtype='<f4',
+            mode='r',
+            shape=(manifest["rows"], manifest["dim"])
+        )
+
+    def open_prefix(self, manifest: Optional[Dict[str, Any]] = None) -> Optional[np.ndarray]:
+        """Memory-map the Matryoshka prefix rows, or None for stores created without a prefix file"""
+        manifest = manifest or self.read_manifest()
+        if not manifest.get("prefix_dim") or manifest["rows"] == 0:
+            return None
+        return np.memmap(
+            self._prefix_path(manifest["generation"]),
+            dtype='<f4',
+            mode='r',
+            shape=(manifest["rows"], manifest["prefix_dim"])
+        )
+
+    def _write_rows(self, path: Path, rows: int, dim: int, blocks: Iterable[np.ndarray]):
+        with open(path, "ab") as f:
+            # Drop rows from an earlier append that never made it into the manifest
+            f.truncate(rows * dim * 4)
+            for block in blocks:
+                f.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def document_rows(entry: Dict[str, Any]) -> np.ndarray:
+        """A manifest entry's live rows in document order"""
+        # Entries written before updates kept rows in place hold a single start/count range
+        ranges = entry.get("ranges") or [[entry["start"], entry["count"]]]
+        rows = np.concatenate([np.arange(start, start + count, dtype=np.int64) for start, count in ranges])
+        if entry.get("dead"):
+            rows = rows[~np.isin(rows, entry["dead"])]
+        return rows
+
+    def read(self, document_id: str, revision: Optional[int] = None) -> Optional[np.ndarray]:
+        """Copy one document's (normalised) vectors out of the store
+
+        Given a revision, returns None when the store holds some other revision of the document.
+        """
+        manifest = self.read_manifest()
+        entry = manifest["documents"][document_id]
+        if revision is not None and entry.get("revision", revision) != revision:
+            return None
+        return np.array(self.open(manifest)[self.document_rows(entry)])
+
+    def _write_appended_rows(
+        self,
+        manifest: Dict[str, Any],
+        count: int,
+        dim: int,
+        blocks: Callable[[], Iterable[np.ndarray]]
+    ) -> int:
+        """Write count normalised rows past the end of the data file and return the first one's row number
+
+        blocks() yields the rows a slice at a time and is called once per file written. The
+        (unsaved) manifest's row count covers the new rows afterwards.
+        """
+        if manifest["rows"] == 0:
+            manifest["dim"] = dim
+            manifest["prefix_dim"] = min(EMBEDDING_PREFIX_DIMENSIONS, dim)
+        elif dim != manifest["dim"]:
+            raise ValueError(f"Embedding dimension {dim} does not match store dimension {manifest['dim']}")
+
+        self._write_rows(self._data_path(manifest["generation"]), manifest["rows"], dim, blocks())
+        if manifest.get("prefix_dim"):
+            self._write_rows(
+                self._prefix_path(manifest["generation"]),
+                manifest["rows"],
+                manifest["prefix_dim"],
+                (matryoshka_prefix(block, manifest["prefix_dim"]) for block in blocks())
+            )
+        start = manifest["rows"]
+        manifest["rows"] += count
+        return start
+
+    def _append_rows(
+        self,
+        manifest: Dict[str, Any],
+        document_id: str,
+        count: int,
+        dim: int,
+        blocks: Callable[[], Iterable[np.ndarray]]
+    ) -> Dict[str, Any]:
+        """Append a new document's rows and record them in the (unsaved) manifest"""
+        entry = {"ranges": [[self._write_appended_rows(manifest, count, dim, blocks), count]], "count": count}
+        manifest["documents"][document_id] = entry
+        return entry
+
+    def _compact_if_sparse(self, manifest: Dict[str, Any]):
+        live_rows = sum(entry["count"] for entry in manifest["documents"].values())
+        if manifest["rows"] - live_rows > manifest["rows"] // 4:
+            self._compact(manifest)
+
+    def append(self, document_id: str, embeddings) -> Dict[str, int]:
+        """Append a document's normalised vectors and return its row range; appending twice is a no-op"""
+        vectors = normalize_embeddings(embeddings)
+        with self._locked():
+            manifest = self.read_manifest()
+            if document_id in manifest["documents"]:
+                return manifest["documents"][document_id]
+            entry = self._append_rows(manifest, document_id, len(vectors), vectors.shape[1], lambda: [vectors])
+            self._write_manifest(manifest)
+            return entry
+
+    def _staging_path(self, key: str) -> Path:
+        return self.directory / "staging" / f"{key}.f32"
+
+    def stage(self, key: str, start_row: int, embeddings):
+        """Write a batch of normalised vectors at start_row of a staging file, outside the manifest and the lock
+
+        An ingest job stages its rows batch by batch and moves them into the store in one
+        append_staged() or replace_staged() call once the whole file is written.
+        """
+        vectors = normalize_embeddings(embeddings)
+        path = self._staging_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "r+b" if path.exists() else "wb") as f:
+            f.seek(start_row * vectors.shape[1] * 4)
+            f.write(vectors.astype('<f4').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def staged_rows(self, key: str, dim: int) -> int:
+        """Count the complete rows in a staging file"""
+        try:
+            return self._staging_path(key).stat().st_size // (dim * 4)
+        except FileNotFoundError:
+            return 0
+
+    def discard_staged(self, key: str):
+        self._staging_path(key).unlink(missing_ok=True)
+
+    def _staged_blocks(self, key: str, count: int, dim: int) -> Iterator[np.ndarray]:
+        if count == 0:
+            return
+        staged = np.memmap(self._staging_path(key), dtype='<f4', mode='r', shape=(count, dim))
+        for start in range(0, count, STORE_COPY_ROWS):
+            yield np.array(staged[start:start + STORE_COPY_ROWS])
+
+    def append_staged(self, document_id: str, key: str, count: int, dim: int) -> Dict[str, int]:
+        """Append the first count staged rows as a document, then drop the staging file; appending twice is a no-op"""
+        with self._locked():
+            manifest = self.read_manifest()
+            if document_id not in manifest["documents"]:
+                self._append_rows(manifest, document_id, count, dim, lambda: self._staged_blocks(key, count, dim))
+                self._write_manifest(manifest)
+        self.discard_staged(key)
+        return manifest["documents"][document_id]
+
+    def replace_staged(self, document_id: str, removed: List[int], key: str, count: int, dim: int, revision: int):
+        """Tombstone a document's removed rows and append count staged rows, recording the revision they make up
+
+        removed holds positions among the document's live rows. Kept rows stay where they are, so
+        the work is proportional to the change. An entry already at revision is left alone, so an
+        update that stopped between this swap and its database commit can be replayed.
+        """
+        with self._locked():
+            manifest = self.read_manifest()
+            entry = manifest["documents"][document_id]
+            if entry.get("revision") != revision:
+                rows = self.document_rows(entry)
+                ranges = entry.get("ranges") or [[entry["start"], entry["count"]]]
+                if count:
+                    start = self._write_appended_rows(
+                        manifest, count, manifest["dim"] or dim, lambda: self._staged_blocks(key, count, dim)
+                    )
+                    ranges = ranges + [[start, count]]
+                manifest["documents"][document_id] = {
+                    "ranges": ranges,
+                    "dead": sorted(entry.get("dead", []) + rows[removed].tolist()),
+                    "count": len(rows) - len(removed) + count,
+                    "revision": revision
+                }
+                self._write_manifest(manifest)
+                self._compact_if_sparse(manifest)
+        self.discard_staged(key)
+
+    def remove(self, document_id: str):
+        """Forget a document's rows, compacting the data file once enough of it is dead"""
+        with self._locked():
+            manifest = self.read_manifest()
+            if manifest["documents"].pop(document_id, None) is None:
+                return
+            self._write_manifest(manifest)
+            self._compact_if_sparse(manifest)
+
+    def _ann_index_path(self, index_type: str, generation: int) -> Path:
+        return self.directory / f"ann-{index_type}-{generation}.pkl"
+
+    def load_ann_index(self, index_type: str, generation: int) -> Optional["ANNIndex"]:
+        """Load the ANN index persisted for a generation's rows, or None if there is none usable"""
+        try:
+            with open(self._ann_index_path(index_type, generation), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # Written by an older version, or with hnswlib installed and now missing
+            logging.warning(f"Ignoring persisted {index_type} index in {self.directory}: {e}")
+            return None
+
+    def _save_ann_index(self, index: "ANNIndex", generation: int):
+        path = self._ann_index_path(index.index_type, generation)
+        temporary_path = path.with_suffix(".tmp")
+        with open(temporary_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    def save_ann_index(self, index: "ANNIndex", generation: int):
+        """Persist an ANN index next to the data file it covers, unless compaction has replaced that file"""
+        with self._locked():
+            if self.read_manifest()["generation"] == generation:
+                self._save_ann_index(index, generation)
+
+    def _compact(self, manifest: Dict[str, Any]):
+        """Rewrite the live rows into the next generation's data file; existing mappings stay valid
+
+        Persisted ANN indexes are renumbered to the new rows rather than left to be rebuilt.
+        """
+        generation = manifest["generation"] + 1
+        # Each document's live rows, in document order, with documents in file order
+        live = sorted(
+            ((document_id, entry, self.document_rows(entry)) for document_id, entry in manifest["documents"].items()),
+            key=lambda item: int(item[2][0]) if len(item[2]) else -1
+        )
+        files = [(self.open(manifest), self._data_path)]
+        if manifest.get("prefix_dim"):
+            files.append((self.open_prefix(manifest), self._prefix_path))
+        for vectors, path in files:
+            with open(path(generation), "wb") as f:
+                for _, _, rows in live:
+                    for start in range(0, len(rows), STORE_COPY_ROWS):
+                        f.write(np.ascontiguousarray(vectors[rows[start:start + STORE_COPY_ROWS]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        del files
+
+        documents, start = {}, 0
+        new_ids = np.full(manifest["rows"], -1, dtype=np.int64)
+        for document_id, entry, rows in live:
+            documents[document_id] = {
+                **{key: value for key, value in entry.items() if key not in ("start", "dead")},
+                "ranges": [[start, len(rows)]],
+                "count": len(rows)
+            }
+            new_ids[rows] = np.arange(start, start + len(rows))
+            start += len(rows)
+        self._write_manifest({
+            "generation": generation,
+            "dim": manifest["dim"],
+            "prefix_dim": manifest.get("prefix_dim", 0),
+            "rows": start,
+            "documents": documents
+        })
+        self._data_path(manifest["generation"]).unlink(missing_ok=True)
+        self._prefix_path(manifest["generation"]).unlink(missing_ok=True)
+        for index_type in ("hnsw", "ivf"):
+            index = self.load_ann_index(index_type, manifest["generation"])
+            if index is not None:
+                index.remap(new_ids)
+                self._save_ann_index(index, generation)
+            self._ann_index_path(index_type, manifest["generation"]).unlink(missing_ok=True)
+
+def new_ann_index(index_type: str, settings: "SearchSettings") -> ANNIndex:
+    if index_type == "ivf":
+        return IVFIndex(nlist=settings.ivf_nlist)
+    if hnswlib is not None:
+        return HNSWLibIndex(m=settings.hnsw_m, ef_construction=settings.hnsw_ef_construction)
+    return HNSWIndex(m=settings.hnsw_m, ef_construction=settings.hnsw_ef_construction)
+
+def update_ann_index(
+    index: Optional[ANNIndex],
+    index_type: str,
+    settings: "SearchSettings",
+    size: int,
+    new_ids: Optional[np.ndarray] = None,
+    matrix: Optional[np.ndarray] = None,
+    store: Optional[MmapVectorStore] = None,
+    store_generation: Optional[int] = None
+) -> Optional[ANNIndex]:
+    """Bring a tenant's ANN index up to corpus row size in a background worker and return it
+
+    With no index, a mapped corpus starts from the one persisted in its store and saves the
+    result back; other corpora build from scratch. new_ids first renumbers the index after the
+    corpus compacted. A mapped corpus passes its store rather than its matrix, so a CPU pool worker
+    maps the vectors itself instead of being sent a copy.
+    """
+    if store is not None:
+        manifest = store.read_manifest()
+        if manifest["generation"] != store_generation:
+            return None  # Compacted meanwhile; the corpus will ask again
+        matrix = store.open(manifest)
+        if index is None:
+            index = store.load_ann_index(index_type, store_generation)
+            if index is not None and (not index.matches(settings, size) or index.count > size):
+                index = None
+    if index is None:
+        index = new_ann_index(index_type, settings)
+    with index.lock:
+        if new_ids is not None:
+            index.remap(new_ids)
+        changed = new_ids is not None or index.count < size
+        index.insert(matrix, range(index.count, size))
+    if store is not None and changed:
+        store.save_ann_index(index, store_generation)
+    return index
+
+# Tenant embedding cache
+class SemanticAnswerCache:
+    """Recent answers for one tenant, matched to new questions by cosine similarity of their query vectors
+
+    Entries are only valid for the corpus version and search settings they were answered with; a
+    change to either empties the cache.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.version: Any = None
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._entries: List[tuple[str, QueryResponse]] = []  # (language, response), aligned with _vectors
+        self._text_bytes = 0  # Answer and context text held by _entries, kept up to date as they come and go
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _response_bytes(response: QueryResponse) -> int:
+        return len(response.answer) + sum(len(chunk) for chunk in response.context_used)
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes + self._text_bytes
+
+    def lookup(self, version: Any, query_vector: np.ndarray, language: str, threshold: float) -> Optional[QueryResponse]:
+        """Return the answer to the most similar recent question in the same language, if it is close enough"""
+        if version != self.version or not self._entries:
+            self.misses += 1
+            return None
+        scores = self._vectors @ normalize_embeddings(query_vector)[0]
+        for row in np.argsort(-scores):
+            if scores[row] < threshold:
+                break
+            if self._entries[row][0] == language:
+                self.hits += 1
+                return self._entries[row][1]
+        self.misses += 1
+        return None
+
+    def store(self, version: Any, query_vector: np.ndarray, language: str, response: QueryResponse):
+        # An answer without context, such as one given after a failed search, is not worth reusing
+        if self.max_entries <= 0 or not response.context_used:
+            return
+        vector = normalize_embeddings(query_vector)
+        if version != self.version or self._vectors.shape[1:] != vector.shape[1:]:
+            self.version = version
+            self._vectors = np.empty((0, vector.shape[1]), dtype=np.float32)
+            self._entries = []
+            self._text_bytes = 0
+        # Oldest answers make way for new ones
+        drop = max(0, len(self._entries) + 1 - self.max_entries)
+        self._text_bytes += self._response_bytes(response) - sum(
+            self._response_bytes(dropped) for _, dropped in self._entries[:drop]
+        )
+        self._vectors = np.vstack([self._vectors[drop:], vector])
+        self._entries = self._entries[drop:] + [(language, response)]
+
+class TenantCorpus:
+    """In-memory search corpus for one user: a normalised float32 matrix plus a row -> (document, chunk) map"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.dim = 0
+        self.size = 0
+        self.dead_rows = 0
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._row_documents = np.empty(0, dtype=np.int32)
+        self._row_ordinals = np.empty(0, dtype=np.int32)
+        self._live = np.empty(0, dtype=bool)
+        self.chunks: List[str] = []
+        self.chunk_bytes = 0  # Total length of chunks, kept up to date so evict() need not sum it per query
+        self.document_ids: List[str] = []
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self.lock = asyncio.Lock()
+        self.settings = SearchSettings()
+        self.generation = 0
+        self.ann_index = None
+        self.ann_future: Optional[asyncio.Future] = None
+        self.ann_remap: Optional[tuple[ANNIndex, np.ndarray]] = None  # Index awaiting renumbering after compaction
+        self.coarse = None
+        self.coarse_generation = -1
+        self.answer_cache = SemanticAnswerCache(ANSWER_CACHE_MAX_ENTRIES)
+
+    @property
+    def version(self) -> str:
+        """Identify the set of documents and their revisions this corpus currently serves"""
+        documents = sorted((document_id, entry["revision"]) for document_id, entry in self.documents.items())
+        return hashlib.sha256(json.dumps(documents).encode("utf-8")).hexdigest()
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:self.size]
+
+    @property
+    def row_documents(self) -> np.ndarray:
+        return self._row_documents[:self.size]
+
+    @property
+    def row_ordinals(self) -> np.ndarray:
+        return self._row_ordinals[:self.size]
+
+    @property
+    def live(self) -> np.ndarray:
+        return self._live[:self.size]
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self._matrix.nbytes + self._row_documents.nbytes + self._row_ordinals.nbytes
+            + self._live.nbytes + self.chunk_bytes
+            + (self.coarse.nbytes if self.coarse is not None else 0)
+            + self.answer_cache.nbytes
+        )
+
+    def row_map(self, row: int) -> tuple[str, int]:
+        """Return the (document_id, chunk ordinal) a matrix row belongs to"""
+        return self.document_ids[self._row_documents[row]], int(self._row_ordinals[row])
+
+    def document_rows(self, document_id: str) -> np.ndarray:
+        entry = self.documents[document_id]
+        return np.flatnonzero((self.row_documents == entry["index"]) & self.live)
+
+    def _reserve(self, rows: int, dim: int):
+        if self.dim == 0:
+            self.dim = dim
+            self._matrix = np.empty((0, dim), dtype=np.float32)
+        if dim != self.dim:
+            raise ValueError(f"Embedding dimension {dim} does not match corpus dimension {self.dim}")
+
+        needed = self.size + rows
+        if needed <= len(self._matrix):
+            return
+        capacity = max(needed, 2 * len(self._matrix), 1024)
+        matrix = np.empty((capacity, dim), dtype=np.float32)
+        matrix[:self.size] = self.matrix
+        self._matrix = matrix
+        for name in ("_row_documents", "_row_ordinals", "_live"):
+            current = getattr(self, name)
+            grown = np.zeros(capacity, dtype=current.dtype)
+            grown[:self.size] = current[:self.size]
+            setattr(self, name, grown)
+
+    def _append_rows(self, document_index: int, first_ordinal: int, chunks: List[str], embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        self._reserve(len(vectors), vectors.shape[1])
+
+        start, end = self.size, self.size + len(vectors)
+        self._matrix[start:end] = vectors
+        norms = np.linalg.norm(self._matrix[start:end], axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self._matrix[start:end] /= norms
+        self._row_documents[start:end] = document_index
+        self._row_ordinals[start:end] = np.arange(first_ordinal, first_ordinal + len(vectors), dtype=np.int32)
+        self._live[start:end] = True
+        self.chunks.extend(chunks)
+        self.chunk_bytes += sum(len(chunk) for chunk in chunks)
+        self.size = end
+
+    def add_document(self, document_id: str, filename: str, chunks: List[str], embeddings, revision: int = 0):
+        """Append a document's chunk embeddings to the corpus"""
+        if document_id in self.documents or not chunks:
+            return
+        self.documents[document_id] = {"index": len(self.document_ids), "filename": filename, "revision": revision}
+        self.document_ids.append(document_id)
+        self._append_rows(self.documents[document_id]["index"], 0, chunks, embeddings)
+
+    def update_document(
+        self,
+        document_id: str,
+        base_revision: int,
+        removed: List[int],
+        chunks: List[str],
+        embeddings,
+        revision: int
+    ):
+        """Apply a row diff in place: tombstone the removed rows (positions among the document's rows) and append the added ones
+
+        A corpus holding some other revision of the document, or given no vectors for the added rows,
+        just drops it, to be reloaded on the next query.
+        """
+        entry = self.documents.get(document_id)
+        if entry is None:
+            return
+        if entry["revision"] != base_revision or (chunks and embeddings is None):
+            self.remove_document(document_id)
+            return
+        rows = self.document_rows(document_id)
+        if len(rows) - len(removed) + len(chunks) == 0:
+            self.remove_document(document_id)
+            return
+        entry["revision"] = revision
+        self._live[rows[removed]] = False
+        self.dead_rows += len(removed)
+        if chunks:
+            first_ordinal = int(self._row_ordinals[rows[-1]]) + 1 if len(rows) else 0
+            self._append_rows(entry["index"], first_ordinal, chunks, embeddings)
+        if self.dead_rows > self.size // 4:
+            self.compact()
+
+    def remove_document(self, document_id: str):
+        """Tombstone a document's rows, compacting once enough of the matrix is dead"""
+        if document_id not in self.documents:
+            return
+        rows = self.document_rows(document_id)
+        del self.documents[document_id]
+        self._live[rows] = False
+        self.dead_rows += len(rows)
+        if self.dead_rows > self.size // 4:
+            self.compact()
+
+    def compact(self):
+        """Drop tombstoned rows and rebuild the matrix contiguously"""
+        keep = np.flatnonzero(self.live)
+        new_ids = np.full(self.size, -1, dtype=np.int64)
+        new_ids[keep] = np.arange(len(keep))
+        self._matrix = np.ascontiguousarray(self.matrix[keep])
+        self._row_documents = self.row_documents[keep]
+        self._row_ordinals = self.row_ordinals[keep]
+        self._live = np.ones(len(keep), dtype=bool)
+        self.chunks = [self.chunks[row] for row in keep]
+        self.chunk_bytes = sum(len(chunk) for chunk in self.chunks)
+        self.size = len(keep)
+        self.dead_rows = 0
+        # Row numbers changed, so the ANN index must be renumbered before it serves again
+        self.generation += 1
+        if self.ann_remap is not None:
+            # Compacted again before the last renumbering ran; chain the two
+            index, previous = self.ann_remap
+            self.ann_remap = (index, np.where(previous >= 0, new_ids[np.maximum(previous, 0)], -1))
+        elif self.ann_index is not None:
+            self.ann_remap = (self.ann_index, new_ids)
+        self.ann_index = None
+        self.ann_future = None
+
+    def coarse_index(self):
+        """Return the quantised first-pass structure for the tenant's setting, covering every row"""
+        kind = self.settings.quantization
+        if kind == "none":
+            return None
+        if self.coarse is None or self.coarse.kind != kind or self.coarse_generation != self.generation:
+            self.coarse = COARSE_INDEX_TYPES[kind]()
+            self.coarse_generation = self.generation
+        if self.coarse.count < self.size:
+            self.coarse.extend(self.matrix)
+        return self.coarse
+
+    def ann_index_type(self) -> Optional[str]:
+        """Which approximate index this corpus should be searched with, if any"""
+        index_type = self.settings.index_type
+        if index_type == "auto":
+            return "hnsw" if self.size - self.dead_rows >= self.settings.ann_min_rows else None
+        return index_type if index_type in ("hnsw", "ivf") else None
+
+    def start_index_update(self, index: Optional[ANNIndex], index_type: str, settings: "SearchSettings", new_ids) -> asyncio.Future:
+        """Run update_ann_index() for this corpus in the background"""
+        return asyncio.wrap_future(
+            ann_builders.submit(update_ann_index, index, index_type, settings, self.size, new_ids, self.matrix)
+        )
+
+    def schedule_index_update(self, index_type: str):
+        """Build, retrain, renumber or extend the ANN index in the background; searches stay exact until it is ready"""
+        if self.ann_future is not None and not self.ann_future.done():
+            return
+        settings = self.settings
+        index, new_ids = self.ann_index, None
+        if index is None and self.ann_remap is not None:
+            index, new_ids = self.ann_remap
+        if index is not None and (index.index_type != index_type or not index.matches(settings, self.size)):
+            index, new_ids = None, None
+        elif index is not None and new_ids is None and index.count >= self.size:
+            return
+
+        generation = self.generation
+        try:
+            self.ann_future = self.start_index_update(index, index_type, settings, new_ids)
+        except HTTPException:
+            return  # The pool is busy; searches stay on the exact path until a later query asks again
+
+        def install(future: asyncio.Future):
+            if future.cancelled() or future.exception() is not None:
+                logging.error(f"Error building {index_type} index for user {self.user_id}: {future.exception()}")
+            elif generation == self.generation and future.result() is not None:
+                self.ann_index = future.result()
+                self.ann_remap = None
+
+        self.ann_future.add_done_callback(install)
+
+    def ann_search(self, index_type: str, query_vector: np.ndarray, k: int) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """Return live candidate (rows, scores) from the ANN index, or None when it is not usable yet"""
+        self.schedule_index_update(index_type)
+        index = self.ann_index
+        if index is None or index.index_type != index_type or not index.lock.acquire(blocking=False):
+            return None
+        try:
+            if index_type == "hnsw":
+                rows, scores = index.search(self.matrix, query_vector, k, self.settings.hnsw_ef_search)
+            else:
+                rows, scores = index.search(self.matrix, query_vector, self.settings.ivf_nprobe)
+            indexed = index.count
+        finally:
+            index.lock.release()
+
+        # Rows appended since the last index update are scored exactly
+        if indexed < self.size:
+            rows = np.concatenate([rows, np.arange(indexed, self.size)])
+            scores = np.concatenate([scores, self.matrix[indexed:] @ query_vector])
+        keep = self.live[rows]
+        return rows[keep], scores[keep]
+
+class MappedTenantCorpus(TenantCorpus):
+    """Tenant corpus whose matrix is a read-only memory map of the user's on-disk vector store
+
+    Row numbers follow the store's data file, so row metadata is rebuilt from the manifest
+    whenever documents are added or removed.
+    """
+
+    def __init__(self, user_id: str, store: MmapVectorStore):
+        super().__init__(user_id)
+        self.store = store
+        self.store_generation: Optional[int] = None
+        self._registered: Dict[str, tuple[str, List[str], int]] = {}
+        self._prefix: Optional[np.ndarray] = None
+
+    @property
+    def nbytes(self) -> int:
+        # Mapped pages belong to the shared page cache, not to this process
+        return (
+            self._row_documents.nbytes + self._row_ordinals.nbytes
+            + self._live.nbytes + self.chunk_bytes
+            + (self.coarse.nbytes if self.coarse is not None else 0)
+            + self.answer_cache.nbytes
+        )
+
+    def register_document(self, document_id: str, filename: str, chunks: List[str], revision: int = 0):
+        self._registered[document_id] = (filename, chunks, revision)
+
+    def add_document(self, document_id: str, filename: str, chunks: List[str], embeddings=None, revision: int = 0):
+        """Track a document whose vectors have already been appended to the store"""
+        self.register_document(document_id, filename, chunks, revision)
+        self.refresh()
+
+    def update_document(
+        self,
+        document_id: str,
+        base_revision: int,
+        removed: List[int],
+        chunks: List[str],
+        embeddings=None,
+        revision: int = 0
+    ):
+        """Track a document whose rows have already been replaced in the store"""
+        if document_id not in self._registered:
+            return
+        filename, current, registered_revision = self._registered.pop(document_id)
+        if registered_revision == base_revision:
+            dropped = set(removed)
+            kept = [chunk for position, chunk in enumerate(current) if position not in dropped]
+            self.register_document(document_id, filename, kept + chunks, revision)
+        self.refresh()
+
+    def remove_document(self, document_id: str):
+        if self._registered.pop(document_id, None) is not None:
+            self.refresh()
+
+    def compact(self):
+        # The store compacts its own data file; refresh() picks up the new generation
+        self.refresh()
+
+    def start_index_update(self, index: Optional[ANNIndex], index_type: str, settings: "SearchSettings", new_ids) -> asyncio.Future:
+        # The worker maps the store itself, so the CPU pool is sent no vectors
+        return cpu_pool.start(
+            update_ann_index, index, index_type, settings, self.size, new_ids, None, self.store, self.store_generation
+        )
+
+    def coarse_index(self):
+        # Scan the store's prefix file in place rather than keeping a private copy
+        if self.settings.quantization == "prefix" and self._prefix is not None:
+            if not isinstance(self.coarse, PrefixCodes) or self.coarse.vectors is not self._prefix:
+                self.coarse = PrefixCodes(self._prefix)
+                self.coarse_generation = self.generation
+            return self.coarse
+        return super().coarse_index()
+
+    def refresh(self):
+        """Re-map the store and rebuild the row -> (document, chunk) map from its manifest"""
+        manifest = self.store.read_manifest()
+        if manifest["generation"] != self.store_generation:
+            # Compaction renumbered the rows; the store renumbered its persisted index to match
+            self.store_generation = manifest["generation"]
+            self.generation += 1
+            self.ann_index = None
+            self.ann_future = None
+
+        rows = manifest["rows"]
+        self._matrix = self.store.open(manifest)
+        self._prefix = self.store.open_prefix(manifest)
+        self._row_documents = np.zeros(rows, dtype=np.int32)
+        self._row_ordinals = np.zeros(rows, dtype=np.int32)
+        self._live = np.zeros(rows, dtype=bool)
+        self.chunks = [""] * rows
+        self.chunk_bytes = 0
+        self.documents, self.document_ids = {}, []
+        for document_id, (filename, chunks, revision) in self._registered.items():
+            entry = manifest["documents"].get(document_id)
+            if entry is None or entry.get("revision", revision) != revision:
+                # Not appended yet, or swapped for an update whose database commit has not landed
+                continue
+            document_rows = self.store.document_rows(entry)
+            self.documents[document_id] = {"index": len(self.document_ids), "filename": filename, "revision": revision}
+            self.document_ids.append(document_id)
+            self._row_documents[document_rows] = self.documents[document_id]["index"]
+            self._row_ordinals[document_rows] = np.arange(len(document_rows), dtype=np.int32)
+            self._live[document_rows] = True
+            for row, chunk in zip(document_rows.tolist(), chunks):
+                self.chunks[row] = chunk
+                self.chunk_bytes += len(chunk)
+        self.dim = manifest["dim"]
+        self.size = rows
+        self.dead_rows = rows - int(self._live.sum())
+
+class TenantEmbeddingCache:
+    """LRU cache of per-user search corpora bounded by a total byte budget"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._corpora: "OrderedDict[str, TenantCorpus]" = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[TenantCorpus]:
+        corpus = self._corpora.get(user_id)
+        if corpus is not None:
+            self._corpora.move_to_end(user_id)
+        return corpus
+
+    def get_or_create(self, user_id: str) -> TenantCorpus:
+        corpus = self.get(user_id)
+        if corpus is None:
+            if VECTOR_STORE == "mmap":
+                corpus = MappedTenantCorpus(user_id, MmapVectorStore(user_id))
+            else:
+                corpus = TenantCorpus(user_id)
+            self._corpora[user_id] = corpus
+        return corpus
+
+    def invalidate(self, user_id: str):
+        self._corpora.pop(user_id, None)
+
+    def update_document(
+        self,
+        user_id: str,
+        document_id: str,
+        base_revision: int,
+        removed: List[int],
+        chunks: List[str],
+        embeddings,
+        revision: int
+    ):
+        corpus = self.get(user_id)
+        if corpus is not None:
+            corpus.update_document(document_id, base_revision, removed, chunks, embeddings, revision)
+            self.evict()
+
+    def remove_document(self, user_id: str, document_id: str):
+        corpus = self.get(user_id)
+        if corpus is not None:
+            corpus.remove_document(document_id)
+
+    def evict(self):
+        """Drop least recently used corpora until the cache fits its byte budget"""
+        total = sum(corpus.nbytes for corpus in self._corpora.values())
+        while total > self.max_bytes and len(self._corpora) > 1:
+            _, corpus = self._corpora.popitem(last=False)
+            total -= corpus.nbytes
+
+tenant_cache = TenantEmbeddingCache(EMBEDDING_CACHE_MAX_BYTES)
+
+async def move_vectors_to_store(store: MmapVectorStore, document_id: str, embeddings: np.ndarray):
+    """Move a document's vectors from Mongo into the on-disk store, leaving only text and metadata in Mongo"""
+    await asyncio.to_thread(store.append, document_id, embeddings)
+    await db.documents.update_one({"id": document_id}, {"$set": {"vector_store": "mmap"}})
+    await db.chunks.update_many({"document_id": document_id, "pending_job": None}, {"$unset": {"embedding": ""}})
+
+async def load_tenant_corpus(user_id: str) -> TenantCorpus:
+    """Return the user's cached corpus, syncing it with the processed documents in the database"""
+    documents = await db.documents.find(
+        {"user_id": user_id, "processed": True},
+        {"_id": 0, "id": 1, "revision": 1}
+    ).to_list(100)
+    revisions = {doc["id"]: doc.get("revision", 0) for doc in documents}
+    document_ids = list(revisions)
+    settings = await db.search_settings.find_one({"user_id": user_id}, {"_id": 0, "user_id": 0})
+
+    corpus = tenant_cache.get_or_create(user_id)
+    corpus.settings = SearchSettings(**settings) if settings else SearchSettings()
+    async with corpus.lock:
+        # Other workers may have uploaded, updated or deleted documents since this corpus was built
+        for stale_id, entry in list(corpus.documents.items()):
+            if revisions.get(stale_id) != entry["revision"]:
+                corpus.remove_document(stale_id)
+
+        missing_ids = [doc_id for doc_id in document_ids if doc_id not in corpus.documents]
+        if missing_ids:
+            headers = await db.documents.find(
+                {"id": {"$in": missing_ids}, "user_id": user_id},
+                {"_id": 0, "id": 1, "filename": 1, "chunks_count": 1, "vector_store": 1, "revision": 1}
+            ).to_list(None)
+            chunk_data = await load_document_chunks(user_id, missing_ids)
+            legacy_ids = [doc["id"] for doc in headers if "chunks_count" not in doc]
+            if legacy_ids:
+                # Documents written before the chunks collection existed and not migrated yet
+                legacy = await db.documents.find(
+                    {"id": {"$in": legacy_ids}, "user_id": user_id},
+                    {"_id": 0, "id": 1, "chunks": 1, "embeddings": 1, "embedding_dim": 1}
+                ).to_list(None)
+                for doc in legacy:
+                    chunk_data[doc["id"]] = (doc["chunks"], unpack_embeddings(doc))
+            for doc in headers:
+                if doc["id"] not in chunk_data:
+                    continue
+                texts, embeddings = chunk_data[doc["id"]]
+                if isinstance(corpus, MappedTenantCorpus):
+                    if doc.get("vector_store", "mongo") != "mmap":
+                        await move_vectors_to_store(corpus.store, doc["id"], embeddings)
+                    corpus.register_document(doc["id"], doc["filename"], texts, doc.get("revision", 0))
+                else:
+                    if embeddings is None:
+                        embeddings = await asyncio.to_thread(
+                            MmapVectorStore(user_id).read, doc["id"], doc.get("revision", 0)
+                        )
+                        if embeddings is None:
+                            continue  # Swapped for an update whose database commit has not landed
+                    corpus.add_document(doc["id"], doc["filename"], texts, embeddings, doc.get("revision", 0))
+            if isinstance(corpus, MappedTenantCorpus):
+                corpus.refresh()
+
+    tenant_cache.evict()
+    return corpus
+
+# Similarity search
+def top_k_rows(scores: np.ndarray, k: int, threshold: float) -> np.ndarray:
+    """Return the positions of the k highest scores above threshold, best first"""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(scores, -k)[-k:]
+    else:
+        candidates = np.arange(len(scores))
+    candidates = candidates[scores[candidates] > threshold]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+def select_hits(scores: np.ndarray, row_documents: np.ndarray, top_k: int, threshold: float, per_document_cap: Optional[int]) -> np.ndarray:
+    """Pick the global top_k candidate positions, optionally keeping at most per_document_cap per document"""
+    if per_document_cap is None:
+        return top_k_rows(scores, top_k, threshold)
+    if per_document_cap < 1:
+        raise ValueError(f"per_document_cap must be at least 1, got {per_document_cap}")
+
+    # Widen the candidate pool until the capped selection is full or the relevant rows run out
+    relevant = int(np.count_nonzero(scores > threshold))
+    pool = min(top_k * per_document_cap, relevant)
+    while True:
+        selected, per_document = [], {}
+        for position in top_k_rows(scores, pool, threshold):
+            doc_index = int(row_documents[position])
+            if per_document.get(doc_index, 0) < per_document_cap:
+                per_document[doc_index] = per_document.get(doc_index, 0) + 1
+                selected.append(position)
+                if len(selected) == top_k:
+                    break
+        if len(selected) == top_k or pool >= relevant:
+            return np.array(selected, dtype=np.int64)
+        pool = min(pool * 2, relevant)
+
+def coarse_search(corpus: TenantCorpus, coarse, query_vector: np.ndarray, candidates: int) -> tuple[np.ndarray, np.ndarray]:
+    """Shortlist rows with the quantised first pass, then rescore the shortlist against full-precision vectors"""
+    approximate = coarse.scores(query_vector)
+    approximate[~corpus.live] = -np.inf
+    rows = np.sort(top_k_rows(approximate, candidates, -np.inf))
+    return rows, corpus.matrix[rows] @ query_vector
+
+def approximate_candidates(corpus: TenantCorpus, query_vector: np.ndarray, top_k: int, per_document_cap: Optional[int]) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    """Candidate (rows, scores) from the ANN index or the quantised first pass, or None for exact search"""
+    index_type = corpus.ann_index_type()
+    if index_type is not None:
+        candidates = corpus.ann_search(index_type, query_vector, top_k * (per_document_cap or 1))
+        if candidates is not None:
+            return candidates
+    coarse = corpus.coarse_index()
+    if coarse is not None:
+        return coarse_search(corpus, coarse, query_vector, max(corpus.settings.rerank_candidates, top_k))
+    return None
+
+def similarity_search_batch(
+    query_embeddings: List[List[float]],
+    corpus: TenantCorpus,
+    top_k: int = SEARCH_TOP_K,
+    threshold: float = SIMILARITY_THRESHOLD,
+    per_document_cap: Optional[int] = SEARCH_PER_DOCUMENT_CAP
+) -> List[List[tuple[str, float, str]]]:
+    """Return the corpus-wide top_k chunks as (chunk, score, filename) for each query
+
+    Large corpora go through the ANN index or quantised first pass; every query searched
+    exactly shares a single matrix-matrix product over the corpus.
+    """
+    try:
+        query_vectors = normalize_embeddings(query_embeddings)
+        candidate_sets = [approximate_candidates(corpus, query_vector, top_k, per_document_cap) for query_vector in query_vectors]
+
+        exact = [i for i, candidates in enumerate(candidate_sets) if candidates is None]
+        if exact:
+            rows = np.arange(corpus.size)
+            scores = corpus.matrix @ query_vectors[exact].T
+            scores[~corpus.live] = -np.inf
+            for column, i in enumerate(exact):
+                candidate_sets[i] = (rows, scores[:, column])
+
+        results = []
+        for rows, scores in candidate_sets:
+            positions = select_hits(scores, corpus.row_documents[rows], top_k, threshold, per_document_cap)
+            hits = []
+            for row, score in zip(rows[positions], scores[positions]):
+                document_id, _ = corpus.row_map(row)
+                hits.append((corpus.chunks[row], float(score), corpus.documents[document_id]["filename"]))
+            results.append(hits)
+        return results
+    except Exception as e:
+        logging.error(f"Error in similarity search: {e}")
+        return [[] for _ in query_embeddings]
+
+def similarity_search(
+    query_embedding: List[float],
+    corpus: TenantCorpus,
+    top_k: int = SEARCH_TOP_K,
+    threshold: float = SIMILARITY_THRESHOLD,
+    per_document_cap: Optional[int] = SEARCH_PER_DOCUMENT_CAP
+) -> List[tuple[str, float, str]]:
+    """Return the corpus-wide top_k chunks as (chunk, score, filename) for one query"""
+    return similarity_search_batch([query_embedding], corpus, top_k, threshold, per_document_cap)[0]
+
+# Answer generation
+async def generate_answer(query_request: QueryRequest, top_results: List[tuple[str, float, str]]) -> QueryResponse:
+    """Ask the chat model to answer a question from its retrieved chunks"""
+    source_docs = []
+    for _, _, filename in top_results:
+        if filename not in source_docs:
+            source_docs.append(filename)
+    
+    if not top_results:
+        return QueryResponse(
+            answer="Maaf, saya tidak dapat menemukan informasi yang relevan dalam dokumen Anda untuk menjawab pertanyaan tersebut." if query_request.language == "id" else "Sorry, I couldn't find relevant information in your documents to answer that question.",
+            sources=[],
+            context_used=[]
+        )
+    
+    # Prepare context for OpenAI
+    context = "\n\n".join([result[0] for result in top_results])
+    context_used = [result[0] for result in top_results]
+    
+    # Generate response using OpenAI
+    system_prompt = (
+        "Anda adalah asisten AI yang membantu menganalisis data dan membuat laporan. "
+        "Berdasarkan konteks yang diberikan, berikan jawaban yang akurat dan informatif. "
+        "Jika pertanyaan dalam bahasa Indonesia, jawab dalam bahasa Indonesia. "
+        "Jika dalam bahasa Inggris, jawab dalam bahasa Inggris."
+        if query_request.language == "id" else
+        "You are an AI assistant that helps analyze data and create reports. "
+        "Based on the provided context, give accurate and informative answers. "
+        "Answer in the same language as the question."
+    )
+    
+    try:
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {query_request.query}\n\nPlease provide a comprehensive answer based on the context provided."}
+        ]
+        # The provider counts the prompt plus max_tokens against the token budget
+        tokens = sum(count_embedding_tokens([message["content"] for message in messages])) + CHAT_MAX_TOKENS
+        response = await chat_rate_limiter.call(
+            lambda: openai_client.chat.completions.with_raw_response.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                max_tokens=CHAT_MAX_TOKENS,
+                temperature=0.3,
+                timeout=OPENAI_CHAT_TIMEOUT
+            ),
+            tokens
+        )
+        
+        answer = response.choices[0].message.content
+        
+    except Exception as e:
+        logging.error(f"Error generating response: {e}")
+        raise HTTPException(status_code=500, detail="Error generating response")
+    
+    return QueryResponse(
+        answer=answer,
+        sources=source_docs,
+        context_used=context_used
+    )
+
+# Ingestion jobs
+class IngestError(Exception):
+    """Permanent ingestion failure that retrying cannot fix"""
 
-# OpenAI client
-openai_client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+class IngestAborted(Exception):
+    """The job was cancelled or its lease passed to another worker"""
 
-# JWT settings
-JWT_SECRET = "your-secret-key-change-in-production"
-JWT_ALGORITHM = "HS256"
-JWT_EXPIRATION = timedelta(days=7)
+ingest_wakeup = asyncio.Event()
 
-# Create the main app without a prefix
-app = FastAPI(title="RAG SaaS Application", description="AI-powered document analysis and reporting")
+async def claim_ingest_job(worker_id: str) -> Optional[IngestJob]:
+    """Lease the oldest queued job, or a running job whose worker stopped renewing its lease"""
+    now = datetime.utcnow()
+    job = await db.ingest_jobs.find_one_and_update(
+        {"$or": [{"status": "queued"}, {"status": "running", "lease_expires_at": {"$lt": now}}]},
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": worker_id,
+                "lease_expires_at": now + timedelta(seconds=INGEST_LEASE_SECONDS),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    return IngestJob(**job) if job else None
 
-# Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+async def update_ingest_job(job: IngestJob, updates: Dict[str, Any]):
+    """Record progress and renew the lease, raising IngestAborted if this worker no longer owns the job"""
+    now = datetime.utcnow()
+    result = await db.ingest_jobs.update_one(
+        {"id": job.id, "status": "running", "worker_id": job.worker_id},
+        {"$set": {**updates, "lease_expires_at": now + timedelta(seconds=INGEST_LEASE_SECONDS), "updated_at": now}}
+    )
+    if result.matched_count == 0:
+        raise IngestAborted()
 
-# Security
-security = HTTPBearer()
+def staging_key(job: IngestJob) -> str:
+    """Name of the vector store staging file a job writes its vectors to"""
+    return job.document_id if job.base_revision is None else f"{job.document_id}.{job.id}"
 
-# Models
-class User(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    email: str
-    name: str
-    password_hash: str
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+async def discard_ingested_document(job: IngestJob):
+    """Remove everything a failed or cancelled job stored for its document"""
+    if job.base_revision is not None:
+        # An update only owns the rows it added; the stored version stays as it was
+        await db.chunks.delete_many({"user_id": job.user_id, "document_id": job.document_id, "pending_job": job.id})
+        MmapVectorStore(job.user_id).discard_staged(staging_key(job))
+        try:
+            await upload_bucket.delete(job.file_id)
+        except NoFile:
+            pass
+        return
+    await db.documents.delete_one({"id": job.document_id, "user_id": job.user_id, "processed": False})
+    await db.chunks.delete_many({"user_id": job.user_id, "document_id": job.document_id})
+    store = MmapVectorStore(job.user_id)
+    store.discard_staged(staging_key(job))
+    if VECTOR_STORE == "mmap":
+        await asyncio.to_thread(store.remove, job.document_id)
+    try:
+        await upload_bucket.delete(job.file_id)
+    except NoFile:
+        pass
 
-class UserCreate(BaseModel):
-    email: str
-    name: str
-    password: str
+async def download_upload(file_id: Any) -> str:
+    """Copy a stored upload into a temporary file for the parser thread, returning its path"""
+    try:
+        stream = await upload_bucket.open_download_stream(file_id)
+    except NoFile:
+        raise IngestError("Uploaded file is missing")
+    with tempfile.NamedTemporaryFile(prefix="upload-", delete=False) as upload:
+        try:
+            while True:
+                data = await stream.readchunk()
+                if not data:
+                    break
+                upload.write(data)
+        except BaseException:
+            os.unlink(upload.name)
+            raise
+    return upload.name
 
-class UserLogin(BaseModel):
-    email: str
-    password: str
+def parse_upload(path: str, file_type: str, batch_size: int, batches, stop):
+    """Parse an upload on an ingest parser thread, sending ("batch", (chunks, data)) messages then ("done", None)
 
-class Document(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    user_id: str
-    filename: str
-    file_type: str
-    content: List[Dict[str, Any]]
-    embeddings: List[List[float]]
-    chunks: List[str]
-    uploaded_at: datetime = Field(default_factory=datetime.utcnow)
-    processed: bool = False
+    A parse failure is sent as ("error", message). batches is bounded, so the parser runs at most a
+    few batches ahead of embedding; setting stop makes it give up at the next batch.
+    """
+    def send(message) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(message, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-class QueryRequest(BaseModel):
-    query: str
-    language: str = "en"  # "en" or "id"
+    reader = iter_excel_batches if file_type == "excel" else iter_json_batches
+    try:
+        with open(path, "rb") as upload:
+            for batch in reader(upload, batch_size):
+                if not send(("batch", batch)):
+                    return
+    except Exception as e:
+        send(("error", str(e)))
+        return
+    send(("done", None))
 
-class QueryResponse(BaseModel):
-    answer: str
-    sources: List[str]
-    context_used: List[str]
+async def load_stored_rows(job: IngestJob) -> tuple[List[int], Dict[str, deque]]:
+    """Return the committed rows' ordinals in order and a row hash -> positions map to diff a new version against"""
+    rows = await db.chunks.find(
+        {"user_id": job.user_id, "document_id": job.document_id, "pending_job": None},
+        {"_id": 0, "ordinal": 1, "row_hash": 1, "text": 1}
+    ).sort([("user_id", 1), ("document_id", 1), ("ordinal", 1)]).to_list(None)
+    # Rows written before row hashes were stored are hashed from their text
+    ordinals = [row["ordinal"] for row in rows]
+    return ordinals, row_positions(row.get("row_hash") or row_hash(row["text"]) for row in rows)
 
-# Helper functions
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def row_positions(hashes: Iterable[str]) -> Dict[str, deque]:
+    """Map each row hash to the positions of the stored rows that have it, in order"""
+    positions: Dict[str, deque] = {}
+    for position, hash_ in enumerate(hashes):
+        positions.setdefault(hash_, deque()).append(position)
+    return positions
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+def match_rows(unmatched: Dict[str, deque], chunks: List[str]) -> List[int]:
+    """Claim one unmatched stored row per chunk with the same hash, returning the offsets of chunks left over
 
-def create_jwt_token(user_id: str) -> str:
-    payload = {
-        "user_id": user_id,
-        "exp": datetime.utcnow() + JWT_EXPIRATION
-    }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    Whatever is still in unmatched once the whole new version has been matched was removed from it.
+    """
+    added = []
+    for offset, chunk in enumerate(chunks):
+        matches = unmatched.get(row_hash(chunk))
+        if matches:
+            matches.popleft()
+        else:
+            added.append(offset)
+    return added
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("user_id")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = await db.users.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return User(**user)
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+def unmatched_rows(unmatched: Dict[str, deque]) -> List[int]:
+    """Positions of the stored rows no chunk of the new version claimed"""
+    return sorted(position for positions in unmatched.values() for position in positions)
 
-def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Generate embeddings using OpenAI API"""
-    try:
-        response = openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=texts
+async def commit_document_update(
+    job: IngestJob,
+    ordinals: List[int],
+    unmatched: Dict[str, deque],
+    added_count: int,
+    embedding_dim: int
+):
+    """Swap an update job's added rows in for the stored rows its file no longer contains"""
+    document = await db.documents.find_one(
+        {"id": job.document_id, "user_id": job.user_id},
+        {"_id": 0, "vector_store": 1, "revision": 1}
+    )
+    if document is None:
+        # The document was deleted while the new version was being ingested
+        await db.ingest_jobs.update_one({"id": job.id}, {"$set": {"status": "cancelled"}})
+        raise IngestAborted()
+    base_revision = document.get("revision", 0)
+    removed = unmatched_rows(unmatched)
+    chunks_count = len(ordinals) - len(removed) + added_count
+    if chunks_count == 0:
+        raise IngestError("Could not process file content")
+
+    if document.get("vector_store") == "mmap":
+        await asyncio.to_thread(
+            MmapVectorStore(job.user_id).replace_staged,
+            job.document_id, removed, staging_key(job), added_count, embedding_dim, base_revision + 1
         )
-        return [embedding.embedding for embedding in response.data]
-    except Exception as e:
-        logging.error(f"Error generating embeddings: {e}")
-        return []
+    # Only the added rows are loaded, to patch a cached corpus in place
+    texts, embeddings = (await load_document_chunks(job.user_id, [job.document_id], pending_job=job.id)).get(
+        job.document_id, ([], None)
+    )
+    
+    await db.chunks.update_many(
+        {"user_id": job.user_id, "document_id": job.document_id, "pending_job": job.id},
+        {"$unset": {"pending_job": ""}}
+    )
+    removed_ordinals = [ordinals[position] for position in removed]
+    for start in range(0, len(removed_ordinals), CHUNK_INSERT_BATCH_SIZE):
+        await db.chunks.delete_many({
+            "user_id": job.user_id,
+            "document_id": job.document_id,
+            "ordinal": {"$in": removed_ordinals[start:start + CHUNK_INSERT_BATCH_SIZE]}
+        })
+    await db.documents.update_one(
+        {"id": job.document_id, "user_id": job.user_id},
+        {
+            "$set": {"chunks_count": chunks_count, "uploaded_at": datetime.utcnow()},
+            "$inc": {"revision": 1}
+        }
+    )
+    await update_ingest_job(job, {"status": "completed", "error": None})
+    tenant_cache.update_document(
+        job.user_id, job.document_id, base_revision, removed, texts, embeddings, base_revision + 1
+    )
 
-def process_excel_file(file_content: bytes) -> tuple[List[str], List[Dict[str, Any]]]:
-    """Process Excel file and extract text chunks"""
-    try:
-        df = pd.read_excel(io.BytesIO(file_content))
-        
-        # Convert DataFrame to structured data
-        data = df.to_dict('records')
-        
-        # Create text chunks from each row
-        chunks = []
-        for row in data:
-            chunk = " | ".join([f"{k}: {v}" for k, v in row.items() if pd.notna(v)])
-            chunks.append(chunk)
-        
-        return chunks, data
-    except Exception as e:
-        logging.error(f"Error processing Excel file: {e}")
-        return [], []
+async def commit_document(job: IngestJob, chunks_count: int, embedding_dim: int):
+    """Mark a newly ingested document searchable, moving its staged vectors into the on-disk store when configured
 
-def process_json_file(file_content: bytes) -> tuple[List[str], List[Dict[str, Any]]]:
-    """Process JSON file and extract text chunks"""
-    try:
-        data = json.loads(file_content.decode('utf-8'))
-        
-        if isinstance(data, list):
-            chunks = []
-            for item in data:
-                if isinstance(item, dict):
-                    chunk = " | ".join([f"{k}: {v}" for k, v in item.items()])
-                    chunks.append(chunk)
-                else:
-                    chunks.append(str(item))
-            return chunks, data
-        else:
-            # Single object
-            chunk = " | ".join([f"{k}: {v}" for k, v in data.items()]) if isinstance(data, dict) else str(data)
-            return [chunk], [data]
-    except Exception as e:
-        logging.error(f"Error processing JSON file: {e}")
-        return [], []
+    Cached corpora pick the document up on their next query.
+    """
+    if VECTOR_STORE == "mmap":
+        await asyncio.to_thread(
+            MmapVectorStore(job.user_id).append_staged,
+            job.document_id, staging_key(job), chunks_count, embedding_dim
+        )
+    result = await db.documents.update_one(
+        {"id": job.document_id, "user_id": job.user_id},
+        {"$set": {
+            "processed": True,
+            "chunks_count": chunks_count,
+            "embedding_dim": embedding_dim,
+            "vector_store": VECTOR_STORE
+        }}
+    )
+    if result.matched_count == 0:
+        # The document was deleted while it was being ingested
+        await db.ingest_jobs.update_one({"id": job.id}, {"$set": {"status": "cancelled"}})
+        raise IngestAborted()
+    await update_ingest_job(job, {"status": "completed", "error": None})
 
-def similarity_search(query_embedding: List[float], document_embeddings: List[List[float]], chunks: List[str], top_k: int = 5) -> List[tuple[str, float]]:
-    """Perform similarity search using cosine similarity"""
+async def run_ingest_job(job: IngestJob):
+    """Stream, embed and write one uploaded file through a batch pipeline, resuming after the last checkpoint
+
+    A new version of an existing document is diffed row by row against the stored one, so only
+    added or changed rows are embedded and written.
+    """
+    update = job.base_revision is not None
+    if update:
+        # Nothing is visible until the update commits, so a retry starts over; the content
+        # embedding cache makes re-embedding the rows it already added cheap
+        await db.chunks.delete_many({"user_id": job.user_id, "document_id": job.document_id, "pending_job": job.id})
+        job.processed_chunks = 0
+        ordinals, unmatched = await load_stored_rows(job)
+        next_ordinal = staging_offset = ordinals[-1] + 1 if ordinals else 0
+        stored = await db.documents.find_one({"id": job.document_id, "user_id": job.user_id}, {"_id": 0, "vector_store": 1})
+        vector_store = stored.get("vector_store", "mongo") if stored else "mongo"
+    else:
+        staging_offset = 0
+        vector_store = VECTOR_STORE
+    # Vectors bound for the on-disk store are staged batch by batch and moved into it on commit
+    store = MmapVectorStore(job.user_id) if vector_store == "mmap" else None
+    if not update:
+        if store is not None and job.processed_chunks:
+            # The checkpoint can run ahead of a staging file lost with the previous worker's disk
+            job.processed_chunks = min(
+                job.processed_chunks,
+                await asyncio.to_thread(store.staged_rows, staging_key(job), job.embedding_dim)
+            )
+        # Rows past the checkpoint may have been partly written before the previous attempt stopped
+        await db.chunks.delete_many({
+            "user_id": job.user_id,
+            "document_id": job.document_id,
+            "ordinal": {"$gte": job.processed_chunks}
+        })
+    
+    document = Document(
+        id=job.document_id,
+        user_id=job.user_id,
+        filename=job.filename,
+        file_type=job.file_type,
+        vector_store=vector_store
+    )
+    
+    # Parser -> embedding workers -> writer, joined by bounded queues so stages overlap without
+    # buffering more than a few batches
+    parsed: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_DEPTH)
+    embedded: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_DEPTH)
+    position = 0
+    added_count = 0
+    embedding_dim = job.embedding_dim
+    
+    async def parse():
+        nonlocal position, next_ordinal
+        path = await download_upload(job.file_id)
+        # Parsing runs on this job's parser thread; this stage only waits for its batches
+        batches, stop = queue.Queue(INGEST_QUEUE_DEPTH), threading.Event()
+        parser = asyncio.get_running_loop().run_in_executor(
+            ingest_parsers, parse_upload, path, job.file_type, INGEST_BATCH_SIZE, batches, stop
+        )
+        try:
+            while True:
+                try:
+                    kind, value = await asyncio.to_thread(batches.get, True, 1.0)
+                except queue.Empty:
+                    if parser.done():
+                        parser.result()
+                        raise RuntimeError("Parser stopped without finishing the file")
+                    continue
+                if kind == "error":
+                    raise IngestError(f"Could not process file content: {value}")
+                if kind == "done":
+                    break
+                
+                chunks, data = value
+                start, position = position, position + len(chunks)
+                if update:
+                    # Keep only rows with no unclaimed match in the stored version
+                    added = match_rows(unmatched, chunks)
+                    await update_ingest_job(job, {"processed_chunks": position})
+                    if added:
+                        start, next_ordinal = next_ordinal, next_ordinal + len(added)
+                        await parsed.put((start, [chunks[i] for i in added], [data[i] for i in added]))
+                    continue
+                if position <= job.processed_chunks:
+                    continue  # Embedded and written by an earlier attempt
+                skip = max(0, job.processed_chunks - start)
+                await parsed.put((start + skip, chunks[skip:], data[skip:]))
+        finally:
+            stop.set()
+            os.unlink(path)
+        for _ in range(INGEST_EMBED_WORKERS):
+            await parsed.put(None)
+    
+    async def embed():
+        while (batch := await parsed.get()) is not None:
+            start, chunks, data = batch
+            embeddings = await get_embeddings(job.user_id, chunks)
+            if len(embeddings) == 0:
+                raise RuntimeError("Error generating embeddings")
+            await embedded.put((start, chunks, data, embeddings))
+        await embedded.put(None)
+    
+    async def write():
+        nonlocal added_count, embedding_dim
+        # Batches can finish out of order; the checkpoint only advances over a contiguous prefix
+        checkpoint = job.processed_chunks
+        written: Dict[int, int] = {}
+        remaining_workers = INGEST_EMBED_WORKERS
+        while remaining_workers:
+            batch = await embedded.get()
+            if batch is None:
+                remaining_workers -= 1
+                continue
+            start, chunks, data, embeddings = batch
+            embedding_dim = embeddings.shape[1]
+            if store is not None:
+                await asyncio.to_thread(store.stage, staging_key(job), start - staging_offset, embeddings)
+            if update:
+                await write_document_chunks(document, chunks, data, embeddings, start_ordinal=start, pending_job=job.id)
+                added_count += len(chunks)
+                continue
+            await write_document_chunks(document, chunks, data, embeddings, start_ordinal=start)
+            written[start] = start + len(chunks)
+            if checkpoint in written:
+                while checkpoint in written:
+                    checkpoint = written.pop(checkpoint)
+                await update_ingest_job(job, {"processed_chunks": checkpoint, "embedding_dim": embedding_dim})
+    
+    stages = [asyncio.create_task(parse()), asyncio.create_task(write())]
+    stages += [asyncio.create_task(embed()) for _ in range(INGEST_EMBED_WORKERS)]
     try:
-        query_embedding = np.array(query_embedding).reshape(1, -1)
-        doc_embeddings = np.array(document_embeddings)
-        
-        similarities = cosine_similarity(query_embedding, doc_embeddings)[0]
-        
-        # Get top_k most similar chunks
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        
-        results = []
-        for idx in top_indices:
-            if similarities[idx] > 0.1:  # Threshold for relevance
-                results.append((chunks[idx], float(similarities[idx])))
+        done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+    for stage in done:
+        if stage.exception() is not None:
+            raise stage.exception()
+    
+    if position == 0:
+        raise IngestError("Could not process file content")
+    await update_ingest_job(job, {"total_chunks": position})
+    if update:
+        await commit_document_update(job, ordinals, unmatched, added_count, embedding_dim)
+    else:
+        await commit_document(job, position, embedding_dim)
+    
+    try:
+        await upload_bucket.delete(job.file_id)
+    except NoFile:
+        pass
+
+async def handle_failed_ingest_job(job: IngestJob, error: Exception):
+    """Requeue a failed job to resume from its checkpoint, or give up after INGEST_MAX_ATTEMPTS"""
+    logging.error(f"Error ingesting {job.filename} (job {job.id}, attempt {job.attempts}): {error}")
+    permanent = isinstance(error, IngestError) or job.attempts >= INGEST_MAX_ATTEMPTS
+    result = await db.ingest_jobs.update_one(
+        {"id": job.id, "status": "running", "worker_id": job.worker_id},
+        {"$set": {
+            "status": "failed" if permanent else "queued",
+            "error": str(error),
+            "worker_id": None,
+            "lease_expires_at": None,
+            "updated_at": datetime.utcnow()
+        }}
+    )
+    if permanent and result.matched_count:
+        await discard_ingested_document(job)
+
+async def ingest_worker(worker_id: str):
+    """Claim and run ingestion jobs until the task is cancelled"""
+    while True:
+        ingest_wakeup.clear()
+        try:
+            job = await claim_ingest_job(worker_id)
+        except Exception as e:
+            logging.error(f"Error claiming ingestion job: {e}")
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(ingest_wakeup.wait(), timeout=INGEST_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
         
-        return results
-    except Exception as e:
-        logging.error(f"Error in similarity search: {e}")
-        return []
+        try:
+            await run_ingest_job(job)
+        except IngestAborted:
+            job_status = await db.ingest_jobs.find_one({"id": job.id}, {"_id": 0, "status": 1})
+            if job_status is not None and job_status["status"] == "cancelled":
+                await discard_ingested_document(job)
+        except Exception as e:
+            try:
+                await handle_failed_ingest_job(job, e)
+            except Exception as e:
+                logging.error(f"Error recording failed ingestion job {job.id}: {e}")
 
 # Auth endpoints
 @api_router.post("/auth/register")
@@ -251,14 +3018,24 @@ async def delete_document(
     current_user: User = Depends(get_current_user)
 ):
     # Find and delete the document
-    result = await db.documents.delete_one({
-        "id": document_id,
-        "user_id": current_user.id
-    })
+    document = await db.documents.find_one_and_delete(
+        {"id": document_id, "user_id": current_user.id},
+        projection={"_id": 0, "vector_store": 1}
+    )
     
-    if result.deleted_count == 0:
+    if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
     
+    # Stop any ingestion still running for it; the worker cleans up what it already wrote
+    await db.ingest_jobs.update_many(
+        {"document_id": document_id, "status": {"$in": ["queued", "running"]}},
+        {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}
+    )
+    await db.chunks.delete_many({"user_id": current_user.id, "document_id": document_id})
+    if document.get("vector_store") == "mmap":
+        await asyncio.to_thread(MmapVectorStore(current_user.id).remove, document_id)
+    tenant_cache.remove_document(current_user.id, document_id)
+    
     return {"message": "Document deleted successfully"}
 
 @api_router.post("/documents/upload")
@@ -269,53 +3046,101 @@ async def upload_document(
     if not file.filename:
         raise HTTPException(status_code=400, detail="No file provided")
     
-    # Read file content
-    content = await file.read()
-    
-    # Process file based on type
+    # Check the file type; parsing happens in the ingestion worker
     file_extension = file.filename.lower().split('.')[-1]
     
     if file_extension in ['xlsx', 'xls']:
-        chunks, data = process_excel_file(content)
         file_type = "excel"
-    elif file_extension == 'json':
-        chunks, data = process_json_file(content)
+    elif file_extension in ['json', 'jsonl', 'ndjson']:
         file_type = "json"
     else:
         raise HTTPException(status_code=400, detail="Unsupported file type. Please upload Excel or JSON files.")
     
-    if not chunks:
+    if not file.size:
         raise HTTPException(status_code=400, detail="Could not process file content")
     
-    # Generate embeddings
-    embeddings = get_embeddings(chunks)
-    if not embeddings:
-        raise HTTPException(status_code=500, detail="Error generating embeddings")
+    # A file with the name of a processed document is a new version of it, merged in by row diff
+    existing = await db.documents.find_one(
+        {
+            "user_id": current_user.id,
+            "filename": file.filename,
+            "file_type": file_type,
+            "processed": True,
+            "chunks_count": {"$exists": True}
+        },
+        {"_id": 0, "id": 1, "revision": 1},
+        sort=[("uploaded_at", -1)]
+    )
+    if existing is not None:
+        active = await db.ingest_jobs.find_one(
+            {"document_id": existing["id"], "status": {"$in": ["queued", "running"]}},
+            {"_id": 0, "id": 1}
+        )
+        if active is not None:
+            raise HTTPException(status_code=409, detail="A previous version of this file is still being processed")
+        document = Document(id=existing["id"], user_id=current_user.id, filename=file.filename, file_type=file_type)
+    else:
+        document = Document(user_id=current_user.id, filename=file.filename, file_type=file_type)
     
-    # Save document to database
-    document = Document(
+    # Store the raw file and queue it; the document (or its new version) becomes searchable once its job completes
+    file_id = await upload_bucket.upload_from_stream(
+        file.filename,
+        file.file,
+        metadata={"user_id": current_user.id, "document_id": document.id}
+    )
+    job = IngestJob(
         user_id=current_user.id,
-        filename=file.filename,
+        document_id=document.id,
+        filename=document.filename,
         file_type=file_type,
-        content=data,
-        embeddings=embeddings,
-        chunks=chunks,
-        processed=True
+        file_id=file_id,
+        base_revision=existing.get("revision", 0) if existing is not None else None
     )
     
-    await db.documents.insert_one(document.dict())
+    if existing is None:
+        await db.documents.insert_one(document.dict())
+    await db.ingest_jobs.insert_one(job.dict())
+    ingest_wakeup.set()
     
     return {
-        "message": "Document uploaded and processed successfully",
+        "message": "Document uploaded and queued for processing" if existing is None else "New version uploaded and queued for update",
+        "job_id": job.id,
         "document_id": document.id,
         "filename": document.filename,
-        "chunks_count": len(chunks),
-        "file_type": file_type
+        "file_type": file_type,
+        "status": job.status
+    }
+
+@api_router.get("/documents/jobs/{job_id}")
+async def get_ingest_job(
+    job_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    job = await db.ingest_jobs.find_one({"id": job_id, "user_id": current_user.id}, {"_id": 0})
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return {
+        "job_id": job["id"],
+        "document_id": job["document_id"],
+        "filename": job["filename"],
+        "file_type": job["file_type"],
+        "status": job["status"],
+        "total_chunks": job["total_chunks"],
+        "processed_chunks": job["processed_chunks"],
+        "progress": job["processed_chunks"] / job["total_chunks"] if job["total_chunks"] else None,
+        "attempts": job["attempts"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"]
     }
 
 @api_router.get("/documents")
 async def list_documents(current_user: User = Depends(get_current_user)):
-    documents = await db.documents.find({"user_id": current_user.id}).to_list(100)
+    documents = await db.documents.find(
+        {"user_id": current_user.id},
+        {"_id": 0, "id": 1, "filename": 1, "file_type": 1, "uploaded_at": 1, "processed": 1, "chunks_count": 1, "chunks": 1}
+    ).to_list(100)
     
     return [
         {
@@ -324,12 +3149,144 @@ async def list_documents(current_user: User = Depends(get_current_user)):
             "file_type": doc["file_type"],
             "uploaded_at": doc["uploaded_at"],
             "processed": doc["processed"],
-            "chunks_count": len(doc.get("chunks", []))
+            "chunks_count": doc.get("chunks_count", len(doc.get("chunks", [])))
         }
         for doc in documents
     ]
 
+# Search settings endpoints
+@api_router.get("/settings/search", response_model=SearchSettings)
+async def get_search_settings(current_user: User = Depends(get_current_user)):
+    settings = await db.search_settings.find_one({"user_id": current_user.id}, {"_id": 0, "user_id": 0})
+    return SearchSettings(**settings) if settings else SearchSettings()
+
+@api_router.put("/settings/search", response_model=SearchSettings)
+async def update_search_settings(
+    settings: SearchSettings,
+    current_user: User = Depends(get_current_user)
+):
+    if settings.index_type not in ("auto", "flat", "hnsw", "ivf"):
+        raise HTTPException(status_code=400, detail="index_type must be one of: auto, flat, hnsw, ivf")
+    if settings.quantization not in QUANTIZATION_TYPES:
+        raise HTTPException(status_code=400, detail=f"quantization must be one of: {', '.join(QUANTIZATION_TYPES)}")
+    
+    await db.search_settings.update_one(
+        {"user_id": current_user.id},
+        {"$set": settings.dict()},
+        upsert=True
+    )
+    
+    corpus = tenant_cache.get(current_user.id)
+    if corpus is not None:
+        corpus.settings = settings
+    
+    return settings
+
+def measure_quantization_recall(corpus: TenantCorpus, kind: str, samples: int, top_k: int) -> Dict[str, Any]:
+    """Compare quantised search against exact float32 search, using sampled chunk vectors as queries"""
+    live_rows = np.flatnonzero(corpus.live)
+    rng = np.random.default_rng(0)
+    query_rows = rng.choice(live_rows, size=min(samples, len(live_rows)), replace=False)
+    coarse = COARSE_INDEX_TYPES[kind]()
+    coarse.extend(corpus.matrix)
+
+    coarse_hits = reranked_hits = 0
+    for query_row in query_rows:
+        query_vector = np.asarray(corpus.matrix[query_row], dtype=np.float32)
+        # The query chunk trivially finds itself, so leave it out of every result list
+        exact = corpus.matrix @ query_vector
+        exact[~corpus.live] = -np.inf
+        exact[query_row] = -np.inf
+        truth = set(top_k_rows(exact, top_k, -np.inf).tolist())
+
+        approximate = coarse.scores(query_vector)
+        approximate[~corpus.live] = -np.inf
+        approximate[query_row] = -np.inf
+        coarse_hits += len(truth & set(top_k_rows(approximate, top_k, -np.inf).tolist()))
+
+        rows, scores = coarse_search(corpus, coarse, query_vector, max(corpus.settings.rerank_candidates, top_k) + 1)
+        scores[rows == query_row] = -np.inf
+        reranked_hits += len(truth & set(rows[top_k_rows(scores, top_k, -np.inf)].tolist()))
+
+    total = max(len(query_rows) * min(top_k, len(live_rows) - 1), 1)
+    return {
+        "quantization": kind,
+        "samples": len(query_rows),
+        "top_k": top_k,
+        "rerank_candidates": corpus.settings.rerank_candidates,
+        "coarse_recall": coarse_hits / total,
+        "reranked_recall": reranked_hits / total
+    }
+
+@api_router.get("/settings/search/recall")
+async def check_quantization_recall(
+    quantization: Optional[str] = None,
+    samples: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    corpus = await load_tenant_corpus(current_user.id)
+    kind = quantization or corpus.settings.quantization
+    if kind not in QUANTIZATION_TYPES or kind == "none":
+        raise HTTPException(status_code=400, detail=f"quantization must be one of: {', '.join(QUANTIZATION_TYPES[1:])}")
+    if corpus.size - corpus.dead_rows < 2:
+        raise HTTPException(status_code=400, detail="Not enough indexed chunks to measure recall")
+    
+    async with corpus.lock:
+        return await asyncio.to_thread(measure_quantization_recall, corpus, kind, min(max(samples, 1), 1000), SEARCH_TOP_K)
+
 # RAG Query endpoint
+class SingleFlight:
+    """Run one computation per key at a time; callers arriving while it runs await the same result"""
+
+    def __init__(self):
+        self._flights: Dict[Any, asyncio.Task] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def run(self, key: Any, compute: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.create_task(compute())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.started += 1
+        else:
+            self.shared += 1
+        # Shielded so a caller that disconnects does not cancel the answer the others are waiting for
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Any, task: asyncio.Task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here in case every caller had already gone
+
+query_flights = SingleFlight()
+
+async def answer_query(query_request: QueryRequest, corpus: TenantCorpus) -> QueryResponse:
+    """Embed, search and answer one question against a loaded corpus"""
+    # Generate query embedding
+    query_embeddings = await get_query_embeddings(corpus.user_id, [query_request.query])
+    if len(query_embeddings) == 0:
+        raise HTTPException(status_code=500, detail="Error processing query")
+    
+    query_embedding = query_embeddings[0]
+    
+    # A paraphrase of a recent question over the same corpus reuses its answer without a chat call
+    version = (corpus.version, corpus.settings)
+    cached = corpus.answer_cache.lookup(
+        version, query_embedding, query_request.language, corpus.settings.answer_cache_similarity
+    )
+    if cached is not None:
+        return cached
+    
+    # Search across all documents in a single pass
+    top_results = similarity_search(query_embedding, corpus)
+    
+    response = await generate_answer(query_request, top_results)
+    corpus.answer_cache.store(version, query_embedding, query_request.language, response)
+    return response
+
 @api_router.post("/query", response_model=QueryResponse)
 async def rag_query(
     query_request: QueryRequest,
@@ -338,87 +3295,62 @@ async def rag_query(
     if not query_request.query.strip():
         raise HTTPException(status_code=400, detail="Query cannot be empty")
     
-    # Get user's documents
-    documents = await db.documents.find({"user_id": current_user.id, "processed": True}).to_list(100)
+    # Get user's cached embedding corpus
+    corpus = await load_tenant_corpus(current_user.id)
     
-    if not documents:
+    if not corpus.documents:
         raise HTTPException(status_code=400, detail="No processed documents found. Please upload documents first.")
     
-    # Generate query embedding
-    query_embeddings = get_embeddings([query_request.query])
-    if not query_embeddings:
-        raise HTTPException(status_code=500, detail="Error processing query")
-    
-    query_embedding = query_embeddings[0]
+    # Identical questions asked at the same time share one embedding, search and chat completion
+    key = (current_user.id, normalize_query(query_request.query), query_request.language, corpus.version)
+    return await query_flights.run(key, lambda: answer_query(query_request, corpus))
+
+@api_router.post("/query/batch", response_model=BatchQueryResponse)
+async def rag_query_batch(
+    batch_request: BatchQueryRequest,
+    current_user: User = Depends(get_current_user)
+):
+    if not batch_request.queries:
+        raise HTTPException(status_code=400, detail="At least one query is required")
+    if len(batch_request.queries) > BATCH_QUERY_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"A batch can contain at most {BATCH_QUERY_MAX_QUERIES} queries")
+    if any(not query_request.query.strip() for query_request in batch_request.queries):
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
     
-    # Search across all documents
-    all_results = []
-    source_docs = []
+    corpus = await load_tenant_corpus(current_user.id)
     
-    for doc in documents:
-        doc_results = similarity_search(
-            query_embedding, 
-            doc["embeddings"], 
-            doc["chunks"], 
-            top_k=3
-        )
-        
-        for chunk, score in doc_results:
-            all_results.append((chunk, score, doc["filename"]))
-            if doc["filename"] not in source_docs:
-                source_docs.append(doc["filename"])
+    if not corpus.documents:
+        raise HTTPException(status_code=400, detail="No processed documents found. Please upload documents first.")
     
-    # Sort by similarity score and take top results
-    all_results.sort(key=lambda x: x[1], reverse=True)
-    top_results = all_results[:5]
+    # Embed every question in a single request
+    query_embeddings = await get_query_embeddings(current_user.id, [query_request.query for query_request in batch_request.queries])
+    if len(query_embeddings) != len(batch_request.queries):
+        raise HTTPException(status_code=500, detail="Error processing query")
     
-    if not top_results:
-        return QueryResponse(
-            answer="Maaf, saya tidak dapat menemukan informasi yang relevan dalam dokumen Anda untuk menjawab pertanyaan tersebut." if query_request.language == "id" else "Sorry, I couldn't find relevant information in your documents to answer that question.",
-            sources=[],
-            context_used=[]
-        )
+    all_results = similarity_search_batch(query_embeddings, corpus)
     
-    # Prepare context for OpenAI
-    context = "\n\n".join([result[0] for result in top_results])
-    context_used = [result[0] for result in top_results]
+    # Answer the questions concurrently, bounded so one batch cannot monopolise the chat quota
+    semaphore = asyncio.Semaphore(BATCH_QUERY_CONCURRENCY)
     
-    # Generate response using OpenAI
-    system_prompt = (
-        "Anda adalah asisten AI yang membantu menganalisis data dan membuat laporan. "
-        "Berdasarkan konteks yang diberikan, berikan jawaban yang akurat dan informatif. "
-        "Jika pertanyaan dalam bahasa Indonesia, jawab dalam bahasa Indonesia. "
-        "Jika dalam bahasa Inggris, jawab dalam bahasa Inggris."
-        if query_request.language == "id" else
-        "You are an AI assistant that helps analyze data and create reports. "
-        "Based on the provided context, give accurate and informative answers. "
-        "Answer in the same language as the question."
-    )
+    async def answer(query_request: QueryRequest, top_results: List[tuple[str, float, str]]) -> QueryResponse:
+        async with semaphore:
+            return await generate_answer(query_request, top_results)
     
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {query_request.query}\n\nPlease provide a comprehensive answer based on the context provided."}
-            ],
-            max_tokens=500,
-            temperature=0.3
-        )
-        
-        answer = response.choices[0].message.content
-        
-    except Exception as e:
-        logging.error(f"Error generating response: {e}")
-        raise HTTPException(status_code=500, detail="Error generating response")
+    results = await asyncio.gather(*[
+        answer(query_request, top_results)
+        for query_request, top_results in zip(batch_request.queries, all_results)
+    ])
     
-    return QueryResponse(
-        answer=answer,
-        sources=source_docs,
-        context_used=context_used
-    )
+    return BatchQueryResponse(results=results)
 
 # Report generation endpoint
+def build_report_workbook(report_data: List[Dict[str, Any]]) -> bytes:
+    """Render report rows as an .xlsx workbook"""
+    df = pd.DataFrame(report_data)
+    excel_file = io.BytesIO()
+    df.to_excel(excel_file, index=False, sheet_name='RAG Report')
+    return excel_file.getvalue()
+
 @api_router.post("/reports/generate")
 async def generate_report(
     query_request: QueryRequest,
@@ -428,7 +3360,7 @@ async def generate_report(
     rag_response = await rag_query(query_request, current_user)
     
     # Get user's documents for additional context
-    documents = await db.documents.find({"user_id": current_user.id, "processed": True}).to_list(100)
+    document_count = await db.documents.count_documents({"user_id": current_user.id, "processed": True})
     
     # Extract data from documents and context for Excel report
     report_data = []
@@ -454,17 +3386,14 @@ async def generate_report(
             "Language": query_request.language,
             "Generated_At": datetime.utcnow().isoformat(),
             "Sources": ", ".join(rag_response.sources),
-            "Document_Count": len(documents)
+            "Document_Count": document_count
         }]
     
-    # Create Excel file
-    df = pd.DataFrame(report_data)
-    excel_file = io.BytesIO()
-    df.to_excel(excel_file, index=False, sheet_name='RAG Report')
-    excel_file.seek(0)
+    # Create Excel file in the worker pool
+    excel_bytes = await cpu_pool.run(build_report_workbook, report_data)
     
     # Convert to base64 for JSON response
-    excel_b64 = base64.b64encode(excel_file.getvalue()).decode()
+    excel_b64 = base64.b64encode(excel_bytes).decode()
     
     return {
         "message": "Excel report generated successfully",
@@ -475,6 +3404,19 @@ async def generate_report(
         "sources": rag_response.sources
     }
 
+# Embedding cache statistics
+@api_router.get("/embedding-cache/stats")
+async def embedding_cache_stats(current_user: User = Depends(get_current_user)):
+    # Only the caller's own entries and counters, never cache-wide figures
+    return {
+        **content_cache.stats(current_user.id),
+        "stored_entries": await db.embedding_cache.count_documents({"user_id": current_user.id}),
+        "query": {
+            **query_cache.stats(current_user.id),
+            "stored_entries": await db.query_embedding_cache.count_documents({"user_id": current_user.id})
+        }
+    }
+
 # Health check
 @api_router.get("/health")
 async def health_check():
@@ -498,6 +3440,86 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def migrate_legacy_documents(batch_size: int = 20):
+    """Move chunks and embeddings stored inside document records into the chunks collection"""
+    converted = 0
+    try:
+        while True:
+            documents = await db.documents.find(
+                {"chunks_count": {"$exists": False}},
+                {"_id": 0, "id": 1, "user_id": 1, "filename": 1, "file_type": 1, "content": 1, "chunks": 1, "embeddings": 1, "embedding_dim": 1, "vector_store": 1}
+            ).to_list(batch_size)
+            if not documents:
+                break
+            for doc in documents:
+                chunks = doc.get("chunks", [])
+                embeddings = unpack_embeddings(doc).reshape(len(chunks), -1)
+                document = Document(
+                    id=doc["id"],
+                    user_id=doc["user_id"],
+                    filename=doc["filename"],
+                    file_type=doc["file_type"],
+                    chunks_count=len(chunks),
+                    embedding_dim=embeddings.shape[1],
+                    vector_store=doc.get("vector_store", "mongo")
+                )
+                # Clear any rows left by an interrupted earlier run before rewriting them
+                await db.chunks.delete_many({"document_id": document.id})
+                await write_document_chunks(document, chunks, doc.get("content", []), embeddings)
+                await db.documents.update_one(
+                    {"id": document.id},
+                    {
+                        "$set": {"chunks_count": document.chunks_count, "embedding_dim": document.embedding_dim},
+                        "$unset": {"content": "", "chunks": "", "embeddings": ""}
+                    }
+                )
+            converted += len(documents)
+    except Exception as e:
+        logging.error(f"Error migrating legacy documents: {e}")
+    if converted:
+        logger.info(f"Migrated {converted} documents to the chunks collection")
+
+@app.on_event("startup")
+async def start_background_migrations():
+    await db.chunks.create_index([("user_id", 1), ("document_id", 1), ("ordinal", 1)], unique=True)
+    for cache in (content_cache, query_cache):
+        await db[cache.collection].create_index("created_at", expireAfterSeconds=EMBEDDING_STORE_TTL_DAYS * 86400)
+        await db[cache.collection].create_index("user_id")
+    app.state.migration_task = asyncio.create_task(migrate_legacy_documents())
+
+@app.on_event("startup")
+async def start_ingest_workers():
+    await db.ingest_jobs.create_index([("id", 1)], unique=True)
+    await db.ingest_jobs.create_index([("status", 1), ("created_at", 1)])
+    app.state.ingest_workers = [
+        asyncio.create_task(ingest_worker(f"{os.getpid()}-{uuid.uuid4().hex[:8]}"))
+        for _ in range(INGEST_WORKERS)
+    ]
+
+@app.on_event("startup")
+async def load_embedding_tokenizer():
+    # The first load may download the vocabulary, which must not happen on the event loop
+    await asyncio.to_thread(embedding_tokenizer)
+
+@app.on_event("startup")
+async def warm_openai_connections():
+    """Open keep-alive connections to OpenAI before the first user request pays for the TLS handshake"""
+    async def warm():
+        try:
+            await openai_client.models.list(timeout=OPENAI_CONNECT_TIMEOUT)
+        except Exception as e:
+            logging.warning(f"OpenAI connection warm-up failed: {e}")
+    
+    await asyncio.gather(*[warm() for _ in range(OPENAI_WARM_CONNECTIONS)])
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    # Interrupted jobs resume from their last checkpoint once their lease expires
+    for worker in app.state.ingest_workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.ingest_workers, return_exceptions=True)
+    cpu_pool.shutdown()
+    ingest_parsers.shutdown(wait=False, cancel_futures=True)
+    ann_builders.shutdown(wait=False, cancel_futures=True)
+    client.close()
+    await openai_client.close()
\ No newline at end of file
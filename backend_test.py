@@ -150,7 +150,31 @@ class RAGSaaSAPITester:
         if success and 'document_id' in response:
             self.document_id = response['document_id']
             print(f"Uploaded document ID: {self.document_id}")
-            return True
+            return self.test_ingest_job(response['job_id'])
+        return False
+
+    def test_ingest_job(self, job_id, timeout=120):
+        """Poll an ingestion job until the document is processed"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            success, response = self.run_test(
+                "Ingestion Job Status",
+                "GET",
+                f"documents/jobs/{job_id}",
+                200
+            )
+            if not success:
+                return False
+            
+            print(f"Job status: {response['status']} ({response['processed_chunks']}/{response['total_chunks']} chunks)")
+            if response['status'] == 'completed':
+                return True
+            if response['status'] in ('failed', 'cancelled'):
+                print(f"❌ Ingestion {response['status']}: {response.get('error')}")
+                return False
+            time.sleep(2)
+        
+        print("❌ Ingestion did not finish in time")
         return False
 
     def test_list_documents(self):
@@ -185,6 +209,26 @@ class RAGSaaSAPITester:
             return True
         return False
 
+    def test_batch_query(self, queries=None):
+        """Test batch RAG query"""
+        queries = queries or [
+            {"query": "What is the total sales?", "language": "en"},
+            {"query": "Berapa total penjualan?", "language": "id"}
+        ]
+        success, response = self.run_test(
+            "Batch RAG Query",
+            "POST",
+            "query/batch",
+            200,
+            data={"queries": queries}
+        )
+        
+        if success and len(response.get('results', [])) == len(queries):
+            for result in response['results']:
+                print(f"Query answer: {result['answer'][:100]}...")
+            return True
+        return False
+
     def test_report_generation(self, query_text="What is the total sales?", language="en"):
         """Test report generation"""
         success, response = self.run_test(
@@ -289,6 +333,11 @@ def main():
     if not query_id_success:
         print("❌ Indonesian query failed")
     
+    # Test batch query
+    batch_success = tester.test_batch_query()
+    if not batch_success:
+        print("❌ Batch query failed")
+    
     # Test report generation
     report_success = tester.test_report_generation("What is the total sales?", "en")
     if not report_success:
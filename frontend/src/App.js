@@ -279,11 +279,22 @@ function UploadTab({ onUploadSuccess }) {
         },
       });
       
+      // Processing runs as a background job; poll it until the document is searchable
+      let job;
+      do {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        job = (await axios.get(`${API}/documents/jobs/${response.data.job_id}`)).data;
+      } while (job.status === 'queued' || job.status === 'running');
+      
+      if (job.status !== 'completed') {
+        throw new Error(job.error || 'Processing failed');
+      }
+      
       setUploadResult({
         success: true,
-        message: response.data.message,
+        message: 'Document uploaded and processed successfully',
         filename: response.data.filename,
-        chunks_count: response.data.chunks_count,
+        chunks_count: job.processed_chunks,
         file_type: response.data.file_type
       });
       
@@ -291,7 +302,7 @@ function UploadTab({ onUploadSuccess }) {
     } catch (error) {
       setUploadResult({
         success: false,
-        message: error.response?.data?.detail || 'Upload failed'
+        message: error.response?.data?.detail || error.message || 'Upload failed'
       });
     } finally {
       setUploading(false);
@@ -303,7 +314,8 @@ function UploadTab({ onUploadSuccess }) {
     accept: {
       'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': ['.xlsx'],
       'application/vnd.ms-excel': ['.xls'],
-      'application/json': ['.json']
+      'application/json': ['.json'],
+      'application/x-ndjson': ['.jsonl', '.ndjson']
     },
     maxFiles: 1
   });
@@ -331,7 +343,7 @@ function UploadTab({ onUploadSuccess }) {
               Drop file di sini atau klik untuk upload
             </p>
             <p className="text-gray-500">
-              Mendukung Excel (.xlsx, .xls) dan JSON (.json)
+              Mendukung Excel (.xlsx, .xls) dan JSON (.json, .jsonl)
             </p>
           </div>
         )}
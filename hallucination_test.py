@@ -141,7 +141,32 @@ class RAGHallucinationTester:
         if success and 'document_id' in response:
             self.document_id = response['document_id']
             print(f"Uploaded hallucination test document ID: {self.document_id}")
-            return True
+            # Re-uploading the same filename starts an update job, so wait on whichever job the upload started
+            return self.test_ingest_job(response['job_id'])
+        return False
+
+    def test_ingest_job(self, job_id, timeout=120):
+        """Poll an ingestion job until the document is processed"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            success, response = self.run_test(
+                "Ingestion Job Status",
+                "GET",
+                f"documents/jobs/{job_id}",
+                200
+            )
+            if not success:
+                return False
+            
+            print(f"Job status: {response['status']} ({response['processed_chunks']}/{response['total_chunks']} chunks)")
+            if response['status'] == 'completed':
+                return True
+            if response['status'] in ('failed', 'cancelled'):
+                print(f"❌ Ingestion {response['status']}: {response.get('error')}")
+                return False
+            time.sleep(2)
+        
+        print("❌ Ingestion did not finish in time")
         return False
 
     def test_hallucination_query(self, query_text, language="en"):
@@ -218,10 +243,6 @@ def main():
         print("❌ Document upload failed, stopping tests")
         return 1
     
-    # Wait for document processing
-    print("Waiting 5 seconds for document processing...")
-    time.sleep(5)
-    
     # Test queries for hallucination
     hallucination_tests = [
         {"query": "Show me all items with type 05R", "language": "en"},
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# server.py lives in backend/ and reads its settings from backend/.env on import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
@@ -0,0 +1,141 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import server
+from server import HNSWIndex, IVFIndex, MmapVectorStore, SearchSettings, normalize_embeddings, update_ann_index
+
+
+def random_matrix(rows, dim=16, seed=0):
+    return normalize_embeddings(np.random.default_rng(seed).normal(size=(rows, dim)))
+
+
+def recall(index, matrix, queries, k=10, ef=64):
+    found = 0
+    for query in queries:
+        rows, _ = index.search(matrix, query, k, ef)
+        exact = np.argsort(-(matrix @ query))[:k]
+        found += len(set(rows[:k].tolist()) & set(exact.tolist()))
+    return found / (k * len(queries))
+
+
+def compaction(rows, drop, seed=1):
+    """new_ids for dropping a random share of rows, and the rows kept"""
+    keep = np.sort(np.random.default_rng(seed).choice(rows, size=rows - drop, replace=False))
+    new_ids = np.full(rows, -1, dtype=np.int64)
+    new_ids[keep] = np.arange(len(keep))
+    return new_ids, keep
+
+
+@pytest.mark.parametrize("index_class", [
+    HNSWIndex,
+    pytest.param(server.HNSWLibIndex, marks=pytest.mark.skipif(server.hnswlib is None, reason="hnswlib not installed"))
+])
+def test_hnsw_remap_matches_compacted_rows(index_class):
+    matrix = random_matrix(600)
+    index = index_class(m=8, ef_construction=64)
+    index.insert(matrix, range(len(matrix)))
+    new_ids, keep = compaction(len(matrix), 150)
+    index.remap(new_ids)
+
+    compacted = np.ascontiguousarray(matrix[keep])
+    assert index.count == len(keep)
+    assert recall(index, compacted, random_matrix(20, seed=5)) >= 0.9
+    rows, _ = index.search(compacted, compacted[7], 5, 32)
+    assert rows[0] == 7
+
+
+def test_hnsw_remap_drops_every_link_to_a_removed_node():
+    matrix = random_matrix(300)
+    index = HNSWIndex(m=6, ef_construction=32)
+    index.insert(matrix, range(len(matrix)))
+    new_ids, keep = compaction(len(matrix), 100)
+    index.remap(new_ids)
+
+    for layer, graph in enumerate(index.layers):
+        for node, links in graph.items():
+            assert 0 <= node < len(keep)
+            assert all(0 <= link < len(keep) and link != node for link in links)
+            assert len(links) <= index._max_neighbours(layer)
+    assert index.entry_point in index.layers[-1]
+
+
+def test_hnsw_index_extends_after_remap():
+    matrix = random_matrix(400)
+    index = HNSWIndex(m=8, ef_construction=64)
+    index.insert(matrix[:300], range(300))
+    new_ids = np.full(400, -1, dtype=np.int64)
+    keep = np.arange(0, 400, 2)
+    new_ids[keep] = np.arange(len(keep))
+    index.remap(new_ids)
+
+    # Only the even rows below 300 were indexed; the rest of the compacted matrix is appended
+    compacted = np.ascontiguousarray(matrix[keep])
+    assert index.count == 150
+    index.insert(compacted, range(index.count, len(compacted)))
+    assert index.count == len(compacted)
+    assert recall(index, compacted, random_matrix(20, seed=6)) >= 0.9
+
+
+def test_ivf_remap_keeps_posting_lists():
+    matrix = random_matrix(500)
+    index = IVFIndex(nlist=8)
+    index.insert(matrix, range(len(matrix)))
+    lists = [set(members.tolist()) for members in index.lists]
+    new_ids, keep = compaction(len(matrix), 200)
+    index.remap(new_ids)
+
+    assert index.count == len(keep)
+    assert [set(members.tolist()) for members in index.lists] == [
+        {int(new_ids[row]) for row in members if new_ids[row] >= 0} for members in lists
+    ]
+
+
+def test_index_survives_pickling():
+    matrix = random_matrix(200)
+    index = HNSWIndex(m=8, ef_construction=64)
+    index.insert(matrix, range(len(matrix)))
+    restored = pickle.loads(pickle.dumps(index))
+
+    query = random_matrix(1, seed=3)[0]
+    np.testing.assert_array_equal(restored.search(matrix, query, 5, 32)[0], index.search(matrix, query, 5, 32)[0])
+    with restored.lock:
+        restored.insert(random_matrix(201), [200])
+    assert restored.count == 201
+
+
+def test_store_persists_index_and_renumbers_it_on_compaction(tmp_path):
+    store = MmapVectorStore("user", root=tmp_path)
+    store.append("a", random_matrix(300, seed=1))
+    store.append("b", random_matrix(200, seed=2))
+    settings = SearchSettings(index_type="hnsw", hnsw_m=8, hnsw_ef_construction=64)
+
+    index = update_ann_index(None, "hnsw", settings, 500, None, None, store, 0)
+    assert index.count == 500
+    # A fresh corpus picks the persisted graph up instead of building one
+    loaded = update_ann_index(None, "hnsw", settings, 500, None, None, store, 0)
+    query = random_matrix(1, seed=4)[0]
+    matrix = store.open()
+    assert loaded.count == 500
+    np.testing.assert_array_equal(loaded.search(matrix, query, 5, 32)[0], index.search(matrix, query, 5, 32)[0])
+
+    store.remove("b")  # 40% dead rows, so the store compacts into generation 1
+    manifest = store.read_manifest()
+    assert manifest["generation"] == 1
+    assert not (tmp_path / "user" / "ann-hnsw-0.pkl").exists()
+    remapped = store.load_ann_index("hnsw", 1)
+    assert remapped.count == 300
+
+    matrix = store.open(manifest)
+    rows, _ = remapped.search(matrix, matrix[42], 5, 32)
+    assert rows[0] == 42
+    assert recall(remapped, matrix, random_matrix(20, seed=7)) >= 0.9
+
+
+def test_persisted_index_for_other_settings_is_rebuilt(tmp_path):
+    store = MmapVectorStore("user", root=tmp_path)
+    store.append("a", random_matrix(100))
+    update_ann_index(None, "hnsw", SearchSettings(hnsw_m=8), 100, None, None, store, 0)
+    index = update_ann_index(None, "hnsw", SearchSettings(hnsw_m=12), 100, None, None, store, 0)
+    assert index.m == 12 and index.count == 100
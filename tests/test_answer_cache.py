@@ -0,0 +1,73 @@
+import numpy as np
+
+from server import QueryResponse, SemanticAnswerCache
+
+
+def response(answer, context=("a: 1",)):
+    return QueryResponse(answer=answer, sources=["doc.xlsx"], context_used=list(context))
+
+
+def vector(*values):
+    return np.array([values], dtype=np.float32)
+
+
+def test_similar_question_reuses_the_answer():
+    cache = SemanticAnswerCache(4)
+    cache.store("v1", vector(1, 0, 0), "en", response("first"))
+    assert cache.lookup("v1", vector(0.99, 0.05, 0), "en", 0.95).answer == "first"
+    assert cache.lookup("v1", vector(0, 1, 0), "en", 0.95) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_answer_is_only_reused_in_the_same_language():
+    cache = SemanticAnswerCache(4)
+    cache.store("v1", vector(1, 0), "en", response("english"))
+    assert cache.lookup("v1", vector(1, 0), "id", 0.95) is None
+    cache.store("v1", vector(1, 0), "id", response("indonesian"))
+    assert cache.lookup("v1", vector(1, 0), "id", 0.95).answer == "indonesian"
+    assert cache.lookup("v1", vector(1, 0), "en", 0.95).answer == "english"
+
+
+def test_new_version_or_settings_empty_the_cache():
+    cache = SemanticAnswerCache(4)
+    cache.store(("corpus-1", "settings-1"), vector(1, 0), "en", response("old"))
+    assert cache.lookup(("corpus-2", "settings-1"), vector(1, 0), "en", 0.95) is None
+    assert cache.lookup(("corpus-1", "settings-2"), vector(1, 0), "en", 0.95) is None
+
+    cache.store(("corpus-2", "settings-1"), vector(0, 1), "en", response("new"))
+    assert len(cache._entries) == 1
+    assert cache.lookup(("corpus-1", "settings-1"), vector(1, 0), "en", 0.95) is None
+
+
+def test_oldest_answers_are_evicted():
+    cache = SemanticAnswerCache(2)
+    for i, answer in enumerate(["a", "b", "c"]):
+        cache.store("v1", vector(*np.eye(3)[i]), "en", response(answer))
+    assert cache.lookup("v1", vector(1, 0, 0), "en", 0.95) is None
+    assert cache.lookup("v1", vector(0, 1, 0), "en", 0.95).answer == "b"
+    assert cache.lookup("v1", vector(0, 0, 1), "en", 0.95).answer == "c"
+
+
+def test_answers_without_context_are_not_stored():
+    cache = SemanticAnswerCache(4)
+    cache.store("v1", vector(1, 0), "en", response("Sorry, I couldn't find relevant information", context=()))
+    assert cache.lookup("v1", vector(1, 0), "en", 0.95) is None
+    assert cache.nbytes == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = SemanticAnswerCache(0)
+    cache.store("v1", vector(1, 0), "en", response("first"))
+    assert cache.lookup("v1", vector(1, 0), "en", 0.95) is None
+
+
+def test_byte_count_follows_stores_and_evictions():
+    cache = SemanticAnswerCache(2)
+    answers = [response("x" * 10), response("y" * 20, context=("b: 2", "c: 33")), response("z" * 30)]
+    for i, answer in enumerate(answers):
+        cache.store("v1", vector(*np.eye(3)[i]), "en", answer)
+        assert cache.nbytes == cache._vectors.nbytes + sum(
+            len(r.answer) + sum(len(chunk) for chunk in r.context_used) for _, r in cache._entries
+        )
+    cache.store("v2", vector(1, 0, 0), "en", answers[0])
+    assert cache.nbytes == cache._vectors.nbytes + 10 + len("a: 1")
@@ -0,0 +1,35 @@
+from server import plan_embedding_batches
+
+
+def sizes(batches):
+    return [end - start for start, end in batches]
+
+
+def test_batches_respect_the_input_limit():
+    batches = plan_embedding_batches([1] * 10, max_inputs=4, max_tokens=1000)
+    assert batches == [(0, 4), (4, 8), (8, 10)]
+
+
+def test_batches_respect_the_token_limit():
+    batches = plan_embedding_batches([40, 30, 30, 50, 20, 60], max_inputs=100, max_tokens=100)
+    assert batches == [(0, 3), (3, 5), (5, 6)]
+
+
+def test_text_over_the_token_limit_goes_alone():
+    # It still gets a request of its own rather than being dropped or pulling its neighbours over the limit
+    batches = plan_embedding_batches([10, 500, 10, 10], max_inputs=100, max_tokens=100)
+    assert batches == [(0, 1), (1, 2), (2, 4)]
+    assert plan_embedding_batches([500], max_inputs=100, max_tokens=100) == [(0, 1)]
+
+
+def test_batches_cover_every_text_in_order():
+    counts = [(i * 37) % 90 + 1 for i in range(500)]
+    batches = plan_embedding_batches(counts, max_inputs=16, max_tokens=300)
+    assert batches[0][0] == 0 and batches[-1][1] == len(counts)
+    assert all(end == start for (_, end), (start, _) in zip(batches, batches[1:]))
+    assert all(size <= 16 for size in sizes(batches))
+    assert all(sum(counts[start:end]) <= 300 for start, end in batches)
+
+
+def test_no_texts_no_batches():
+    assert plan_embedding_batches([]) == []
@@ -0,0 +1,67 @@
+import io
+from datetime import datetime
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from server import iter_excel_batches
+
+
+def make_sheet(rows):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    content = io.BytesIO()
+    workbook.save(content)
+    return content.getvalue()
+
+
+def baseline_chunks(content):
+    """The rendering used before uploads were streamed: pd.read_excel, then one chunk per record"""
+    df = pd.read_excel(io.BytesIO(content))
+    data = df.to_dict('records')
+    chunks = []
+    for row in data:
+        chunk = " | ".join([f"{k}: {v}" for k, v in row.items() if pd.notna(v)])
+        chunks.append(chunk)
+    # Blank rows have nothing to embed and are skipped by the streaming reader
+    return [chunk for chunk in chunks if chunk]
+
+
+def streamed_chunks(content, batch_size):
+    chunks = []
+    for batch_chunks, _ in iter_excel_batches(io.BytesIO(content), batch_size):
+        chunks.extend(batch_chunks)
+    return chunks
+
+
+SHEETS = {
+    "blank in numeric columns": [["Qty", "Price", "Name"], [5, 2.0, "a"], [None, 2.5, "b"], [7, 3.0, None]],
+    "integers without blanks": [["a", "b"], [1, 2], [3, 4]],
+    "blank only in last batch": [["Qty"], [1], [2], [3], [None], [5]],
+    "booleans with blanks": [["f", "g"], [True, "True"], [None, "false"], [False, None]],
+    "numeric strings": [["s", "t", "u"], ["1", "1.5", "x"], ["2", "2", "3"], [" 3 ", "1e3", "4"]],
+    "dates": [["d", "e"], [datetime(2024, 1, 2), datetime(2024, 1, 2, 3, 4, 5)], [None, "x"]],
+    "ragged rows": [["a", "a", None], [1, 2, 3, 4], [1], [None, None, None, None, "z"]],
+    "missing value markers": [["a", "b"], ["NA", 1], ["n/a", "None"], ["x", None]],
+    "blank rows between data": [["a", "b"], [1, 2], [None, None], [3, 4], [None, None]],
+    "mixed types": [["a"], [1], ["x"], [2.5], [True]],
+}
+
+
+@pytest.mark.parametrize("name", SHEETS)
+@pytest.mark.parametrize("batch_size", [1, 2, 1000])
+def test_streamed_chunks_match_read_excel(name, batch_size):
+    content = make_sheet(SHEETS[name])
+    assert streamed_chunks(content, batch_size) == baseline_chunks(content)
+
+
+def test_blank_in_numeric_column_renders_floats():
+    content = make_sheet(SHEETS["blank in numeric columns"])
+    assert streamed_chunks(content, 1)[0] == "Qty: 5.0 | Price: 2.0 | Name: a"
+
+
+def test_empty_sheet_yields_nothing():
+    assert streamed_chunks(make_sheet([["only", "a", "header"]]), 10) == []
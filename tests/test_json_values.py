@@ -0,0 +1,73 @@
+import io
+import json
+
+import pytest
+
+import server
+from server import iter_json_batches, iter_json_values
+
+
+@pytest.fixture(params=[1, 3, 1024 * 1024], ids=["1-byte", "3-byte", "default"])
+def read_size(request, monkeypatch):
+    """Read blocks small enough that values, escapes and multi-byte characters straddle block boundaries"""
+    monkeypatch.setattr(server, "JSON_READ_SIZE", request.param)
+    return request.param
+
+
+def values(text):
+    data = text.encode("utf-8") if isinstance(text, str) else text
+    return list(iter_json_values(io.BytesIO(data)))
+
+
+DOCUMENTS = [
+    '[{"a": 1, "b": "x"}, {"a": 0.25, "b": null}]',
+    '[1, -2.5e3, 0.125, true, false, null, "s"]',
+    '[{"nested": {"list": [1, [2, 3]], "text": "a\\"b\\\\c\\u00e9"}}]',
+    '{"single": "object", "n": 10}',
+    ' \n [ {"a" : 1} ,\t{"a":2} ] \n',
+    '[{"kota": "Jakarta", "catatan": "naïve café 日本"}]',
+]
+
+
+@pytest.mark.parametrize("text", DOCUMENTS)
+def test_values_split_across_blocks(read_size, text):
+    expected = json.loads(text)
+    assert values(text) == (expected if isinstance(expected, list) else [expected])
+
+
+def test_byte_order_mark(read_size):
+    assert values(b"\xef\xbb\xbf" + b'[{"a": 1}]') == [{"a": 1}]
+    assert values(b"\xef\xbb\xbf" + b'{"a": 1}\n{"a": 2}\n') == [{"a": 1}, {"a": 2}]
+
+
+def test_jsonl_with_blank_lines(read_size):
+    text = '\n{"a": 1}\n\n{"a": 2.5}\r\n\n  \n{"a": "x"}\n\n'
+    assert values(text) == [{"a": 1}, {"a": 2.5}, {"a": "x"}]
+
+
+def test_empty_array(read_size):
+    assert values("[]") == []
+    assert values(" [ \n ] ") == []
+
+
+def test_empty_file(read_size):
+    assert values("") == []
+
+
+@pytest.mark.parametrize("text", ['[{"a": 1}] x', '[1, 2] [3]', '{"a": 1} garbage'])
+def test_trailing_garbage(read_size, text):
+    with pytest.raises(ValueError):
+        values(text)
+
+
+@pytest.mark.parametrize("text", ['[{"a": 1}, {"b":', '[{"a": 1}', '[1, 2', '{"a": "unterminated', '[1,'])
+def test_truncated_file(read_size, text):
+    with pytest.raises(ValueError):
+        values(text)
+
+
+def test_batches(read_size):
+    text = json.dumps([{"product": f"item{i}", "qty": i} for i in range(5)])
+    batches = list(iter_json_batches(io.BytesIO(text.encode()), 2))
+    assert [len(items) for _, items in batches] == [2, 2, 1]
+    assert batches[0][0] == ["product: item0 | qty: 0", "product: item1 | qty: 1"]
@@ -0,0 +1,158 @@
+import asyncio
+
+import httpx
+import pytest
+from openai import APIConnectionError, RateLimitError
+
+import server
+from server import OpenAIRateLimiter, RateLimitBudget, parse_reset_duration, parse_retry_after
+
+
+class RawResponse:
+    def __init__(self, headers=None, body="ok"):
+        self.headers = headers or {}
+        self.body = body
+
+    def parse(self):
+        return self.body
+
+
+def rate_limit_error(headers=None):
+    request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    return RateLimitError("rate limited", response=httpx.Response(429, request=request, headers=headers or {}), body=None)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(server, "OPENAI_MAX_RETRIES", 3)
+    monkeypatch.setattr(server, "OPENAI_RETRY_BASE_DELAY", 0.0)
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("6m0s", 360.0),
+    ("1.5s", 1.5),
+    ("20ms", 0.02),
+    ("1h2m3s", 3723.0),
+    ("", None),
+    (None, None),
+    ("soon", None),
+])
+def test_parse_reset_duration(value, seconds):
+    assert parse_reset_duration(value) == (pytest.approx(seconds) if seconds is not None else None)
+
+
+def test_parse_retry_after_prefers_milliseconds():
+    assert parse_retry_after({"retry-after-ms": "250", "retry-after": "3"}) == 0.25
+    assert parse_retry_after({"retry-after": "3"}) == 3.0
+    assert parse_retry_after({"retry-after": "Wed, 21 Oct 2026 07:28:00 GMT"}) is None
+    assert parse_retry_after({}) is None
+
+
+def test_budget_refills_at_its_per_minute_rate():
+    budget = RateLimitBudget(60)
+    budget.take(60)
+    start = budget.updated
+    assert budget.wait_time(10, start) == pytest.approx(10.0)
+    assert budget.wait_time(10, start + 4) == pytest.approx(6.0)
+    # Asking for more than the capacity waits for a full bucket, not forever
+    assert budget.wait_time(600, start + 4) == pytest.approx(56.0)
+    assert budget.wait_time(10, start + 120) == 0.0
+    assert budget.available == 60.0
+
+
+def test_budget_adopts_the_provider_headers():
+    budget = RateLimitBudget(1000)
+    budget.sync("500", "120", "10s")
+    assert (budget.capacity, budget.available) == (500.0, 120.0)
+    # A remaining count above what is left locally does not hand back spent budget
+    budget.sync("500", "400", "10s")
+    assert budget.available == pytest.approx(120.0, abs=1.0)
+    budget.sync("500", "not a number", "10s")
+    assert budget.capacity == 500.0
+
+
+def test_exhausted_budget_waits_for_the_reset():
+    budget = RateLimitBudget(600)
+    budget.sync("600", "0", "30s")
+    assert budget.wait_time(1, budget.updated) == pytest.approx(30.1)
+
+
+def test_concurrency_halves_on_rate_limits_and_grows_back_additively():
+    limiter = OpenAIRateLimiter(8, 1000, 100000)
+    limiter.record_rate_limited(None)
+    assert limiter.concurrency == 4.0
+    limiter.record_rate_limited(None)
+    limiter.record_rate_limited(None)
+    limiter.record_rate_limited(None)
+    assert limiter.concurrency == 1.0  # Never below one request at a time
+
+    limiter.record_success({})
+    assert limiter.concurrency == 2.0
+    limiter.record_success({})
+    assert limiter.concurrency == 2.5
+    for _ in range(100):
+        limiter.record_success({})
+    assert limiter.concurrency == 8.0
+
+
+def test_rate_limit_pauses_every_caller_until_retry_after():
+    limiter = OpenAIRateLimiter(4, 1000, 100000)
+    limiter.record_rate_limited(0.5)
+    assert limiter.backoff_until - server.time.monotonic() == pytest.approx(0.5, abs=0.05)
+
+
+def test_success_syncs_both_budgets():
+    limiter = OpenAIRateLimiter(4, 1000, 100000)
+    limiter.record_success({
+        "x-ratelimit-limit-requests": "500",
+        "x-ratelimit-remaining-requests": "499",
+        "x-ratelimit-limit-tokens": "20000",
+        "x-ratelimit-remaining-tokens": "15000",
+    })
+    assert (limiter.requests.capacity, limiter.tokens.capacity) == (500.0, 20000.0)
+    assert limiter.tokens.available == pytest.approx(15000.0, rel=1e-3)
+
+
+def test_call_retries_transient_failures_then_returns():
+    limiter = OpenAIRateLimiter(4, 1000, 100000)
+    failures = [rate_limit_error({"retry-after-ms": "10"}), APIConnectionError(request=httpx.Request("POST", "https://api"))]
+    calls = []
+
+    async def request():
+        calls.append(1)
+        if failures:
+            raise failures.pop(0)
+        return RawResponse(body="embedded")
+
+    assert asyncio.run(limiter.call(request, 10)) == "embedded"
+    assert len(calls) == 3
+    assert limiter.in_flight == 0
+    assert limiter.concurrency == 2.0 + 1 / 2.0  # Halved once, then one additive step
+
+
+def test_call_gives_up_after_the_retry_limit():
+    limiter = OpenAIRateLimiter(4, 1000, 100000)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        raise rate_limit_error()
+
+    with pytest.raises(RateLimitError):
+        asyncio.run(limiter.call(request, 10))
+    assert len(calls) == server.OPENAI_MAX_RETRIES + 1
+    assert limiter.in_flight == 0
+
+
+def test_other_errors_are_not_retried():
+    limiter = OpenAIRateLimiter(4, 1000, 100000)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(limiter.call(request, 10))
+    assert len(calls) == 1
+    assert limiter.in_flight == 0
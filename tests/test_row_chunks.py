@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from server import build_row_chunks
+
+
+def row_loop_chunks(frame):
+    """The original per-row rendering"""
+    return [
+        " | ".join([f"{k}: {v}" for k, v in row.items() if pd.notna(v)])
+        for row in frame.to_dict('records')
+    ]
+
+
+def test_matches_row_loop_across_dtypes():
+    frame = pd.DataFrame({
+        "qty": [5.0, np.nan, 7.0, 1e16],
+        "count": [1, 2, 3, 4],
+        "name": ["a", None, "c", "d"],
+        "flag": [True, False, True, False],
+        "mixed": [1, "x", np.nan, True],
+        "when": [datetime(2024, 1, 2), pd.NaT, datetime(2024, 1, 2, 3, 4, 5), datetime(2024, 1, 2)],
+    })
+    columns = list(frame.columns)
+    assert build_row_chunks(columns, frame.to_numpy(dtype=object).tolist()) == row_loop_chunks(frame)
+
+
+def test_all_missing_row_renders_empty():
+    assert build_row_chunks(["a", "b"], [[None, np.nan], [1, None]]) == ["", "a: 1"]
+
+
+def test_empty_batch():
+    assert build_row_chunks(["a"], []) == []
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import server
+from server import MmapVectorStore, match_rows, normalize_embeddings, row_hash, row_positions, unmatched_rows
+
+
+def diff(stored, new, batch_size=2):
+    """Match a new version against the stored rows batch by batch, as an update job does"""
+    unmatched = row_positions(row_hash(text) for text in stored)
+    added = []
+    for start in range(0, len(new), batch_size):
+        added += [start + offset for offset in match_rows(unmatched, new[start:start + batch_size])]
+    return added, unmatched_rows(unmatched)
+
+
+def apply(stored, new, added, removed):
+    kept = [text for position, text in enumerate(stored) if position not in set(removed)]
+    return kept + [new[offset] for offset in added]
+
+
+def test_unchanged_version_adds_and_removes_nothing():
+    rows = ["a: 1", "b: 2", "c: 3"]
+    assert diff(rows, list(rows)) == ([], [])
+
+
+def test_duplicate_rows_are_matched_one_for_one():
+    stored = ["a: 1", "a: 1", "b: 2"]
+    # One more copy of a duplicated row is added, one fewer copy is removed
+    assert diff(stored, ["a: 1", "a: 1", "a: 1", "b: 2"]) == ([2], [])
+    assert diff(stored, ["a: 1", "b: 2"]) == ([], [1])
+
+
+def test_reordered_rows_are_kept():
+    stored = ["a: 1", "b: 2", "c: 3", "d: 4"]
+    assert diff(stored, ["d: 4", "b: 2", "a: 1", "c: 3"]) == ([], [])
+
+
+def test_changed_and_removed_rows():
+    stored = ["a: 1", "b: 2", "c: 3", "d: 4"]
+    new = ["a: 1", "b: 20", "d: 4"]
+    added, removed = diff(stored, new)
+    assert (added, removed) == ([1], [1, 2])
+    assert sorted(apply(stored, new, added, removed)) == sorted(new)
+
+
+def test_update_to_empty_removes_every_row():
+    stored = ["a: 1", "a: 1", "b: 2"]
+    assert diff(stored, []) == ([], [0, 1, 2])
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 100])
+def test_diff_result_matches_new_version(batch_size):
+    rng = np.random.default_rng(7)
+    stored = [f"k: {value}" for value in rng.integers(0, 6, 40)]
+    new = [f"k: {value}" for value in rng.integers(0, 8, 35)]
+    added, removed = diff(stored, new, batch_size)
+    assert sorted(apply(stored, new, added, removed)) == sorted(new)
+
+
+def test_replaying_a_replace_leaves_the_store_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "STORE_COPY_ROWS", 2)
+    store = MmapVectorStore("user", root=tmp_path)
+    rng = np.random.default_rng(0)
+    old, added = rng.normal(size=(5, 4)), rng.normal(size=(2, 4))
+    store.append("doc", old)
+    expected = normalize_embeddings(np.vstack([old[[0, 2, 4]], added]))
+
+    for _ in range(2):
+        # A retried update stages its rows again and replays the swap at the same revision
+        store.stage("doc.job", 0, added)
+        store.replace_staged("doc", [1, 3], "doc.job", 2, 4, revision=1)
+        np.testing.assert_allclose(store.read("doc"), expected, rtol=1e-6)
+        assert store.read_manifest()["documents"]["doc"]["revision"] == 1
+    assert store.staged_rows("doc.job", 4) == 0
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from server import select_hits, top_k_rows
+
+
+def test_top_k_rows_returns_best_first_above_threshold():
+    scores = np.array([0.3, 0.9, 0.05, 0.6, 0.2])
+    assert top_k_rows(scores, 3, 0.1).tolist() == [1, 3, 0]
+    # Fewer than k rows clear the threshold
+    assert top_k_rows(scores, 10, 0.25).tolist() == [1, 3, 0]
+    assert top_k_rows(scores, 0, 0.1).tolist() == []
+    assert top_k_rows(np.empty(0), 3, 0.1).tolist() == []
+
+
+def test_top_k_rows_breaks_ties_by_position():
+    assert top_k_rows(np.array([0.5, 0.7, 0.5, 0.5]), 4, 0.0).tolist() == [1, 0, 2, 3]
+
+
+def test_select_hits_without_cap_is_the_global_top_k():
+    scores = np.array([0.9, 0.8, 0.7, 0.95, 0.1])
+    documents = np.array([0, 0, 0, 1, 1])
+    # Rows come from any document, ranked across all of them
+    assert select_hits(scores, documents, 3, 0.2, None).tolist() == [3, 0, 1]
+
+
+def test_select_hits_caps_rows_per_document():
+    scores = np.array([0.9, 0.85, 0.8, 0.75, 0.3, 0.2])
+    documents = np.array([0, 0, 0, 0, 1, 2])
+    assert select_hits(scores, documents, 3, 0.1, 1).tolist() == [0, 4, 5]
+    assert select_hits(scores, documents, 3, 0.1, 2).tolist() == [0, 1, 4]
+
+
+def test_select_hits_widens_the_pool_past_a_dominant_document():
+    # The other document's best row ranks far below top_k * cap of the dominant one's
+    scores = np.linspace(0.99, 0.5, 50)
+    documents = np.zeros(50, dtype=np.int32)
+    documents[45] = 1
+    assert select_hits(scores, documents, 2, 0.1, 1).tolist() == [0, 45]
+
+
+def test_select_hits_stops_when_relevant_rows_run_out():
+    scores = np.array([0.9, 0.8, 0.7, 0.05])
+    documents = np.array([0, 0, 0, 1])
+    # The only other document's row is below the threshold, so the selection stays short
+    assert select_hits(scores, documents, 3, 0.1, 1).tolist() == [0]
+    assert select_hits(np.array([0.05, 0.01]), np.array([0, 1]), 2, 0.1, 1).tolist() == []
+
+
+def test_select_hits_rejects_a_cap_below_one():
+    with pytest.raises(ValueError):
+        select_hits(np.array([0.9, 0.8]), np.array([0, 1]), 2, 0.1, 0)
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from server import SingleFlight
+
+
+def test_concurrent_callers_share_one_computation():
+    async def scenario():
+        flights, calls = SingleFlight(), []
+        release = asyncio.Event()
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return "answer"
+
+        callers = [asyncio.create_task(flights.run("key", compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(*callers) == ["answer"] * 3
+        assert (len(calls), flights.started, flights.shared) == (1, 1, 2)
+        # Finished flights are forgotten, so a later caller computes afresh
+        assert await flights.run("key", compute) == "answer"
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def compute(value):
+            await asyncio.sleep(0)
+            return value
+
+        assert await asyncio.gather(flights.run("a", lambda: compute(1)), flights.run("b", lambda: compute(2))) == [1, 2]
+        assert flights.started == 2
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return "answer"
+
+        leaving = asyncio.create_task(flights.run("key", compute))
+        staying = asyncio.create_task(flights.run("key", compute))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await staying == "answer"
+        assert leaving.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_caller_and_clears_the_key():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def fail():
+            await release.wait()
+            raise ValueError("boom")
+
+        callers = [asyncio.create_task(flights.run("key", fail)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert "key" not in flights._flights
+
+        async def succeed():
+            return "retried"
+
+        assert await flights.run("key", succeed) == "retried"
+
+    asyncio.run(scenario())
+
+
+def test_error_with_no_caller_left_is_still_retrieved():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        caller = asyncio.create_task(flights.run("key", fail))
+        await asyncio.sleep(0)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0.01)
+        assert "key" not in flights._flights
+
+    asyncio.run(scenario())
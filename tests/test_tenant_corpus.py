@@ -0,0 +1,40 @@
+import numpy as np
+
+from server import MappedTenantCorpus, MmapVectorStore, TenantCorpus
+
+
+def vectors(count, seed, dim=8):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+
+def chunks(prefix, count):
+    return [f"{prefix}: {'v' * i}" for i in range(count)]
+
+
+def test_chunk_bytes_follow_adds_updates_and_compaction():
+    corpus = TenantCorpus("user")
+    corpus.add_document("a", "a.xlsx", chunks("a", 6), vectors(6, 0))
+    corpus.add_document("b", "b.xlsx", chunks("b", 4), vectors(4, 1))
+    assert corpus.chunk_bytes == sum(len(chunk) for chunk in corpus.chunks)
+
+    corpus.update_document("a", 0, [0, 1], chunks("new", 2), vectors(2, 2), 1)
+    assert corpus.chunk_bytes == sum(len(chunk) for chunk in corpus.chunks)
+    corpus.remove_document("b")  # Enough dead rows to compact
+    assert corpus.generation == 1
+    assert corpus.chunk_bytes == sum(len(chunk) for chunk in corpus.chunks)
+    assert sorted(corpus.chunks) == sorted(chunks("a", 6)[2:] + chunks("new", 2))
+
+
+def test_mapped_chunk_bytes_count_live_rows(tmp_path):
+    store = MmapVectorStore("user", root=tmp_path)
+    store.append("a", vectors(5, 3))
+    store.append("b", vectors(3, 4))
+    corpus = MappedTenantCorpus("user", store)
+    corpus.register_document("a", "a.xlsx", chunks("a", 5))
+    corpus.register_document("b", "b.xlsx", chunks("b", 3))
+    corpus.refresh()
+    assert corpus.chunk_bytes == sum(len(chunk) for chunk in chunks("a", 5) + chunks("b", 3))
+
+    store.remove("b")
+    corpus.remove_document("b")
+    assert corpus.chunk_bytes == sum(len(chunk) for chunk in chunks("a", 5))
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+import server
+from server import MmapVectorStore, normalize_embeddings
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Small copy blocks so every append and replace spans several of them
+    monkeypatch.setattr(server, "STORE_COPY_ROWS", 3)
+    return MmapVectorStore("user", root=tmp_path)
+
+
+def vectors(count, seed, dim=8):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+
+def stage_in_batches(store, key, embeddings, batch_size=4):
+    # Out of order, the way embedding workers finish
+    starts = list(range(0, len(embeddings), batch_size))
+    for start in reversed(starts):
+        store.stage(key, start, embeddings[start:start + batch_size])
+
+
+def test_append_staged_matches_append(store, tmp_path):
+    embeddings = vectors(10, 0)
+    stage_in_batches(store, "doc", embeddings)
+    assert store.staged_rows("doc", 8) == 10
+    entry = store.append_staged("doc", "doc", 10, 8)
+
+    assert entry == {"ranges": [[0, 10]], "count": 10}
+    np.testing.assert_allclose(store.read("doc"), normalize_embeddings(embeddings), rtol=1e-6)
+    np.testing.assert_allclose(
+        store.open_prefix(),
+        server.matryoshka_prefix(embeddings, store.read_manifest()["prefix_dim"]),
+        rtol=1e-6
+    )
+    assert store.staged_rows("doc", 8) == 0
+
+    reference = MmapVectorStore("user", root=tmp_path / "reference")
+    reference.append("doc", embeddings)
+    np.testing.assert_array_equal(store.open(), reference.open())
+
+
+def test_append_staged_twice_is_a_noop(store):
+    stage_in_batches(store, "doc", vectors(5, 1))
+    store.append_staged("doc", "doc", 5, 8)
+    store.append_staged("doc", "doc", 5, 8)
+    assert store.read_manifest()["rows"] == 5
+
+
+def test_replace_staged_keeps_rows_then_appends_staged(store):
+    old, added = vectors(7, 2), vectors(4, 3)
+    store.append("other", vectors(2, 4))
+    store.append("doc", old)
+    stage_in_batches(store, "doc.job", added, batch_size=3)
+    store.replace_staged("doc", [0, 3, 6], "doc.job", 4, 8, 1)
+
+    expected = normalize_embeddings(np.vstack([old[[1, 2, 4, 5]], added]))
+    np.testing.assert_allclose(store.read("doc"), expected, rtol=1e-6)
+    np.testing.assert_allclose(store.read("other"), normalize_embeddings(vectors(2, 4)), rtol=1e-6)
+    assert store.staged_rows("doc.job", 8) == 0
+
+
+def test_replace_staged_without_added_rows(store):
+    old = vectors(6, 5)
+    store.append("doc", old)
+    store.replace_staged("doc", [1], "doc.job", 0, 0, 1)
+    np.testing.assert_allclose(store.read("doc"), normalize_embeddings(old[[0, 2, 3, 4, 5]]), rtol=1e-6)
+
+
+def test_replace_staged_appends_only_the_change(store):
+    old, changed = vectors(10000, 6), vectors(1, 7)
+    store.append("doc", old)
+    store.stage("doc.job", 0, changed)
+    store.replace_staged("doc", [123], "doc.job", 1, 8, 1)
+
+    manifest = store.read_manifest()
+    assert manifest["generation"] == 0
+    assert manifest["rows"] == 10001
+    assert manifest["documents"]["doc"] == {"ranges": [[0, 10000], [10000, 1]], "dead": [123], "count": 10000, "revision": 1}
+    expected = normalize_embeddings(np.vstack([np.delete(old, 123, axis=0), changed]))
+    np.testing.assert_allclose(store.read("doc"), expected, rtol=1e-6)
+
+
+def test_repeated_updates_compact_once_dead_rows_pile_up(store):
+    old = vectors(12, 8)
+    store.append("doc", old)
+    store.stage("doc.job1", 0, vectors(1, 9))
+    store.replace_staged("doc", [0], "doc.job1", 1, 8, 1)
+    store.stage("doc.job2", 0, vectors(1, 10))
+    # Positions are among the live rows: 4 is old row 5, 11 the row the first update added
+    store.replace_staged("doc", [4, 11], "doc.job2", 1, 8, 2)
+    assert store.read_manifest()["generation"] == 0
+
+    kept = [1, 2, 3, 4, 6, 7, 8, 9, 10, 11]
+    expected = normalize_embeddings(np.vstack([old[kept], vectors(1, 10)]))
+    np.testing.assert_allclose(store.read("doc"), expected, rtol=1e-6)
+    store.stage("doc.job3", 0, vectors(1, 11))
+    store.replace_staged("doc", [0], "doc.job3", 1, 8, 3)
+
+    # 4 of 15 rows dead, so the store compacts and the document becomes one range again
+    manifest = store.read_manifest()
+    assert manifest["generation"] == 1
+    assert manifest["documents"]["doc"] == {"ranges": [[0, 11]], "count": 11, "revision": 3}
+    expected = normalize_embeddings(np.vstack([old[kept[1:]], vectors(1, 10), vectors(1, 11)]))
+    np.testing.assert_allclose(store.read("doc"), expected, rtol=1e-6)
+
+
+def test_legacy_entries_are_read_as_one_range(store):
+    store.append("doc", vectors(4, 12))
+    manifest = store.read_manifest()
+    manifest["documents"]["doc"] = {"start": 0, "count": 4}
+    store._write_manifest(manifest)
+    np.testing.assert_allclose(store.read("doc"), normalize_embeddings(vectors(4, 12)), rtol=1e-6)
+
+
+def test_read_skips_a_revision_the_database_has_not_caught_up_with(store):
+    old, changed = vectors(5, 13), vectors(1, 14)
+    store.append("doc", old)
+    store.stage("doc.job", 0, changed)
+    # Same row count before and after, so only the revision tells the versions apart
+    store.replace_staged("doc", [2], "doc.job", 1, 8, 1)
+
+    assert store.read("doc", 0) is None
+    expected = normalize_embeddings(np.vstack([old[[0, 1, 3, 4]], changed]))
+    np.testing.assert_allclose(store.read("doc", 1), expected, rtol=1e-6)